@@ -0,0 +1,187 @@
+import os.path
+import traceback
+import concurrent.futures
+import pandas as pd
+import calc_volume
+import figure_writer
+import polar_grid
+
+'''
+Parses a "key=value;key=value" string from a CSV manifest into a dict. Values that are already dicts (e.g. from a
+YAML manifest) are returned unchanged.
+'''
+def parse_pairs(value):
+    if isinstance(value, dict):
+        return value
+    pairs = {}
+    for item in str(value).split(';'):
+        if item.strip() == '':
+            continue
+        key, val = item.split('=', 1)
+        pairs[key.strip()] = val.strip()
+    return pairs
+
+'''
+Parses a "a;b;c" string from a CSV manifest into a list. Values that are already lists are returned unchanged.
+'''
+def parse_list(value):
+    if isinstance(value, list):
+        return value
+    return [item.strip() for item in str(value).split(';') if item.strip() != '']
+
+'''
+Parses a bad data value from a manifest. Whole numbers that an integer DEM could hold are returned as ints, and other
+values (e.g. -3.4028235e+38 or -9999.5) as floats. Empty values give the default.
+'''
+def parse_bad_data(value, default=32767):
+    if is_blank(value):
+        return default
+    value = float(value)
+    return int(value) if value.is_integer() and abs(value) < 2**53 else value
+
+#Returns true if a manifest field was left empty. Empty fields are '' in a CSV manifest and None in a YAML manifest.
+def is_blank(value):
+    return value is None or str(value).strip() == ''
+
+'''
+Reads a manifest listing the craters to process, one crater per row (CSV) or per list entry (YAML).
+Each crater needs the following fields:
+
+crater = Name of the crater used in output files. Must be unique within the manifest.
+dem_file = Path to the original DEM
+dem_clipped_file = Path to the DEM with all features clipped. Can be left empty if feature_files is a vector file.
+feature_files = Feature names and the DEM files with that feature clipped. In a CSV this is written as
+                "Fan_1=DEM_clip_fan1.tif;Catchment_1=DEM_clip_catchment1.tif". Or a single vector file (GeoJSON,
+                Shapefile or GeoPackage) of the feature polygons, with 'name' and 'match' attributes (see
+                calc_volume.do_calc_vol).
+fan_catchment_match = Fan names and their matching catchments. In a CSV this is written as "Fan_1=Catchment_1;Fan_2=Catchment_2"
+                      Can be left empty if feature_files is a vector file, to use its 'match' attribute.
+
+And optionally:
+center_x, center_y = Coordinates of the crater center in the DEM image. If not given, the center is found
+                     automatically from the crater rim (see find_center.auto_center).
+methods = Fill methods to use. In a CSV this is written as "annular;radial". Defaults to ['annular'].
+pixel_size = DEM pixel size in meters. Defaults to 20.0.
+bad_data = Bad data value, e.g. 32767 or -3.4028235e+38. Defaults to 32767.
+outpath = Directory in which to save results for this crater. Defaults to the outpath given to run_batch.
+window = Part of the DEMs to read, as "xoff;yoff;xsize;ysize" in pixels. Defaults to the whole DEM.
+
+Returns a list of dicts, one per crater, ready to be passed to run_crater.
+'''
+def read_manifest(manifest_file):
+    if manifest_file.lower().endswith(('.yml', '.yaml')):
+        import yaml
+        with open(manifest_file) as f:
+            rows = yaml.safe_load(f)
+        if isinstance(rows, dict):
+            rows = rows['craters']
+    else:
+        rows = pd.read_csv(manifest_file, dtype=str, keep_default_na=False).to_dict('records')
+
+    craters = []
+    for row in rows:
+        vector_features = calc_volume.is_vector_file(row['feature_files'])
+        crater = {'crater': str(row['crater']),
+                  'dem_file': row['dem_file'],
+                  'dem_clipped_file': row.get('dem_clipped_file') or None,
+                  'feature_files': row['feature_files'] if vector_features else parse_pairs(row['feature_files']),
+                  'fan_catchment_match': parse_pairs(row.get('fan_catchment_match') or ''),
+                  'methods': parse_list(row.get('methods') or 'annular'),
+                  'crater_center': None,
+                  'pixel_size': float(row.get('pixel_size') or 20.0),
+                  'bad_data': parse_bad_data(row.get('bad_data')),
+                  'outpath': row.get('outpath') or None,
+                  'window': None}
+        if vector_features and not crater['fan_catchment_match']:
+            crater['fan_catchment_match'] = None
+        if row.get('window'):
+            crater['window'] = [int(float(w)) for w in parse_list(row['window'])]
+        if not is_blank(row.get('center_x')) and not is_blank(row.get('center_y')):
+            crater['crater_center'] = [float(row['center_x']), float(row['center_y'])]
+        craters.append(crater)
+
+    names = [crater['crater'] for crater in craters]
+    if len(set(names)) != len(names):
+        raise ValueError('Crater names in the manifest must be unique: ' + manifest_file)
+    return craters
+
+'''
+Runs do_calc_vol for one crater from the manifest. This is run in a worker process, so it must be a module-level function.
+Craters without a center have it found automatically, never by clicking, so the batch never waits for user input.
+If the automatic center has a low score, do_calc_vol raises an error and the crater is logged as failed.
+'''
+def run_crater(crater, outpath='', savefigs=False, vectorized=True):
+    if crater['outpath'] is not None:
+        outpath = crater['outpath']
+    try:
+        results = calc_volume.do_calc_vol(crater['dem_file'], crater['dem_clipped_file'], crater['feature_files'],
+                                          crater['fan_catchment_match'], crater['methods'],
+                                          crater_center=crater['crater_center'], bad_data=crater['bad_data'],
+                                          pixel_size=crater['pixel_size'], outpath=outpath, cratername=crater['crater'],
+                                          savefigs=savefigs, vectorized=vectorized, window=crater['window'],
+                                          center_method='auto', click_fallback=False)
+    finally:
+        #a failed crater must not leave its polar grids in the worker for the next crater
+        polar_grid.clear_polar_grid_cache()
+    #the worker process can be shut down once run_crater returns, so the figures must be saved first
+    figure_writer.wait_for_figures()
+    return results
+
+'''
+Returns the names of the craters that already have rows in the combined results file.
+'''
+def completed_craters(results_file):
+    if not os.path.isfile(results_file):
+        return set()
+    done = pd.read_csv(results_file, usecols=['crater'], dtype=str)
+    return set(done['crater'])
+
+#Appends the results for one crater to the combined results file, writing the header if the file is new.
+def append_results(results, results_file):
+    write_header = not os.path.isfile(results_file)
+    results.to_csv(results_file, mode='a', header=write_header, index=False)
+
+#Appends a failed crater and its error message to the failure log.
+def log_failure(crater_name, error, failed_file):
+    print('Crater ' + crater_name + ' failed! Skipping it. Error: ' + error.strip().splitlines()[-1])
+    failure = pd.DataFrame.from_dict({'crater': [crater_name], 'error': [error]})
+    failure.to_csv(failed_file, mode='a', header=not os.path.isfile(failed_file), index=False)
+
+'''
+Runs the volume calculation for every crater in a manifest using a pool of worker processes.
+
+manifest_file = CSV or YAML file listing the craters to process. See read_manifest for the format.
+results_file = Combined results CSV. Each crater's rows are appended as soon as that crater finishes. Craters that
+               already appear in this file are skipped, so an interrupted run can be resumed by running it again.
+workers = Number of worker processes. Defaults to the number of CPUs.
+outpath = Directory in which to save per-crater results, unless the manifest gives one.
+savefigs = Set to true to save png figures of the stages of the DEM filling for every crater.
+vectorized = Set to true to use the vectorized versions of the 'annular' and 'radial' methods.
+
+Craters that raise an error are written to a "_failed.csv" file next to the results file and skipped. They will be
+tried again the next time the batch is run.
+'''
+def run_batch(manifest_file, results_file, workers=None, outpath='', savefigs=False, vectorized=True):
+    craters = read_manifest(manifest_file)
+    done = completed_craters(results_file)
+    todo = [crater for crater in craters if crater['crater'] not in done]
+    failed_file = os.path.splitext(results_file)[0] + '_failed.csv'
+    print('Batch of ' + str(len(craters)) + ' craters: ' + str(len(craters) - len(todo)) + ' already done, ' +
+          str(len(todo)) + ' to run')
+
+    n_failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_crater, crater, outpath, savefigs, vectorized): crater['crater'] for crater in todo}
+        for future in concurrent.futures.as_completed(futures):
+            crater_name = futures[future]
+            try:
+                results = future.result()
+            except Exception:
+                log_failure(crater_name, traceback.format_exc(), failed_file)
+                n_failed += 1
+                continue
+            append_results(results, results_file)
+            print('Finished crater ' + crater_name)
+
+    print('Batch finished: ' + str(len(todo) - n_failed) + ' craters completed, ' + str(n_failed) + ' failed')
+    return pd.read_csv(results_file) if os.path.isfile(results_file) else None
@@ -0,0 +1,171 @@
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import calc_volume
+import instrument
+import synthetic_crater
+
+'''
+Benchmarks the fill methods and volume calculation on synthetic craters with known volumes.
+
+For each DEM size, a synthetic crater is made with synthetic_crater.make_crater, and every method is run through
+calc_volume.fill_dem and calc_volume.find_volumes. The wall time, peak memory and volume error of each method are
+written to a JSON file, so runs on different versions of the code can be compared with compare_results. Peak memory is
+recorded twice: as the rise in the resident memory (RSS) of the process, which includes memory allocated outside
+Python by Qhull (griddata) and OpenCV, and as the peak memory allocated by Python and numpy, from tracemalloc. The
+tracemalloc figure comes from a second run of each method, so that tracing does not slow down the timed run.
+
+Run from the command line, e.g.:
+python benchmark.py --sizes 1000 2000 5000 10000 --output benchmark_results.json
+'''
+
+METHODS = ['annular', 'radial', 'mean', 'median', 'min', 'max', 'linear', 'cubic']
+
+#Returns the git commit of the code being benchmarked, if it can be found
+def code_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=sys.path[0] or None).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+'''
+Runs one method on one synthetic crater and returns a dict with the timings, peak memory and volume errors.
+
+crater = Synthetic crater from synthetic_crater.make_crater
+labels, label_names = Label raster of the crater's features, from calc_volume.masks_to_labels
+traced = Set to true to run the method a second time with tracemalloc on, to record the peak memory allocated by
+         Python and numpy. tracemalloc slows down code that makes many small allocations (e.g. the loop fills), so the
+         timings and RSS always come from a run without it.
+'''
+def run_method(crater, labels, label_names, method, bad_data=32767, vectorized=True, local=True, sparse=False,
+               traced=True):
+    center = crater['crater_center']
+    rsize = int(np.sqrt(center[0] ** 2 + center[1] ** 2))
+    tsize = 1000
+
+    #each method calls cv2.warpPolar directly, as it would if run alone (see calc_volume.do_calc_vol)
+    def fill_and_measure():
+        start = time.perf_counter()
+        dem_filled = calc_volume.fill_dem(crater['dem_clipped'], center, rsize, tsize, bad_data=bad_data, method=method,
+                                          savefigs=False, vectorized=vectorized, local=local,
+                                          polar_grid=False, sparse=sparse)
+        fill_time = time.perf_counter() - start
+        start = time.perf_counter()
+        volumes = calc_volume.find_volumes(crater['dem'], dem_filled, labels, label_names,
+                                           crater['fan_catchment_match'], pixel_size=crater['pixel_size'])
+        return volumes, fill_time, time.perf_counter() - start
+
+    with instrument.MemoryMonitor(sample_interval=0.005) as monitor:
+        volumes, fill_time, volume_time = fill_and_measure()
+    peak_rss = None if monitor.peak_mb is None else monitor.peak_mb - monitor.start_mb
+
+    peak_memory = None
+    if traced:
+        tracemalloc.start()
+        try:
+            fill_and_measure()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    errors = {}
+    for key in volumes:
+        truth = crater['true_volumes'][key]
+        errors[key] = {'volume': float(volumes[key]), 'true_volume': float(truth),
+                       'analytic_volume': float(crater['analytic_volumes'][key]),
+                       'relative_error': float((volumes[key] - truth)/truth)}
+    relative_errors = [abs(errors[key]['relative_error']) for key in errors]
+    return {'method': method, 'fill_time': fill_time, 'volume_time': volume_time,
+            'peak_memory_mb': None if peak_memory is None else peak_memory/1e6, 'peak_rss_mb': peak_rss, 'max_abs_relative_error': float(np.nanmax(relative_errors)),
+            'mean_abs_relative_error': float(np.nanmean(relative_errors)), 'features': errors}
+
+'''
+Runs the benchmark for every size and method, and saves the results as JSON.
+
+sizes = List of DEM sizes (pixels along each side) to run
+methods = List of fill methods to run
+n_pairs = Number of fan/catchment pairs in each synthetic crater
+output = JSON file to write the results to. If None, results are only returned.
+vectorized, local, sparse = Passed on to calc_volume.fill_dem
+traced = Set to false to skip the second run of each method that measures its memory with tracemalloc
+'''
+def run_benchmark(sizes=(1000, 2000, 5000, 10000), methods=METHODS, n_pairs=4, output='benchmark_results.json',
+                  vectorized=True, local=True, sparse=False, traced=True):
+    results = {'version': code_version(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.machine(), 'vectorized': vectorized, 'local': local,
+               'sparse': sparse, 'runs': []}
+    for size in sizes:
+        print('Benchmarking a '+str(size)+' x '+str(size)+' synthetic crater')
+        crater = synthetic_crater.make_crater(size=size, n_pairs=n_pairs)
+        labels, label_names = calc_volume.masks_to_labels(crater['masks'])
+        for method in methods:
+            run = run_method(crater, labels, label_names, method, vectorized=vectorized, local=local, sparse=sparse,
+                             traced=traced)
+            run['size'] = size
+            results['runs'].append(run)
+            print(('{:>5} {:>8}: fill {:8.2f} s, volumes {:6.2f} s, peak RSS {:8.1f} MB (traced {:8.1f} MB), '
+                   'max volume error {:6.2%}').format(size, method, run['fill_time'], run['volume_time'],
+                                                      run['peak_rss_mb'] or np.nan, run['peak_memory_mb'] or np.nan,
+                                                      run['max_abs_relative_error']))
+        del crater, labels
+        if output is not None:
+            with open(output, 'w') as f:
+                json.dump(results, f, indent=1)
+    return results
+
+'''
+Compares two benchmark result files, printing the ratio (new/old) of the time and memory of each size and method,
+and the change in volume error. Returns the comparison as a list of dicts.
+'''
+def compare_results(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    old_runs = {(run['size'], run['method']): run for run in old['runs']}
+    print('Comparing '+new['version']+' to '+old['version'])
+    comparison = []
+    for run in new['runs']:
+        key = (run['size'], run['method'])
+        if key not in old_runs:
+            continue
+        old_run = old_runs[key]
+        row = {'size': key[0], 'method': key[1],
+               'fill_time_ratio': run['fill_time']/old_run['fill_time'],
+               'volume_time_ratio': run['volume_time']/old_run['volume_time'],
+               'peak_memory_ratio': run['peak_memory_mb']/old_run['peak_memory_mb'] if run.get('peak_memory_mb') and
+                                    old_run.get('peak_memory_mb') else np.nan,
+               'peak_rss_ratio': run['peak_rss_mb']/old_run['peak_rss_mb'] if run.get('peak_rss_mb') and
+                                 old_run.get('peak_rss_mb') else np.nan,
+               'error_change': run['max_abs_relative_error'] - old_run['max_abs_relative_error']}
+        comparison.append(row)
+        print('{:>5} {:>8}: fill x{:.2f}, volumes x{:.2f}, RSS x{:.2f}, traced memory x{:.2f}, error {:+.2%}'.format(
+            row['size'], row['method'], row['fill_time_ratio'], row['volume_time_ratio'], row['peak_rss_ratio'],
+            row['peak_memory_ratio'], row['error_change']))
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the DEM fill methods on synthetic craters.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 5000, 10000])
+    parser.add_argument('--methods', nargs='+', default=METHODS)
+    parser.add_argument('--pairs', type=int, default=4, help='Number of fan/catchment pairs')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--loop', action='store_true', help='Use the loop versions of the annular and radial fills')
+    parser.add_argument('--griddata', action='store_true', help='Use whole-image griddata for linear and cubic')
+    parser.add_argument('--sparse', action='store_true', help='Calculate the polar fills only at the clipped pixels')
+    parser.add_argument('--no-tracemalloc', action='store_true',
+                        help='Skip the second run of each method that measures its memory with tracemalloc')
+    parser.add_argument('--compare', help='Earlier results file to compare the new results to')
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes, args.methods, n_pairs=args.pairs, output=args.output, vectorized=not args.loop,
+                  local=not args.griddata, sparse=args.sparse, traced=not args.no_tracemalloc)
+    if args.compare:
+        compare_results(args.compare, args.output)
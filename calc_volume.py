@@ -1,36 +1,105 @@
 import os.path
+import concurrent.futures
 import find_center
-import skimage.io as io
-import copy
+import raster_io
 import numpy as np
 import dem_interp
+import figure_writer
+import instrument
 import pandas as pd
+from polar_grid import get_polar_grid, get_adaptive_polar_grid, bounds_radius, clear_polar_grid_cache
 
 
-#Writes the filled DEM to a GDAL file, borrowing properties from the original DEM
-def write_gdal(demfile, filled, filledfile, nodataval = 32767):
+#Writes the filled DEM to a tiled, compressed GeoTIFF, borrowing properties (georeferencing, data type and nodata value)
+#from the original DEM. If the filled DEM is only a window of the original DEM, pass the window to georeference it.
+def write_gdal(demfile, filled, filledfile, nodataval = 32767, window=None):
     print('Saving '+filledfile)
-    from osgeo import gdal
-    dem = gdal.Open(demfile)
-    band = dem.GetRasterBand(1)
-    dem_arr = band.ReadAsArray()
-    [cols,rows] = dem_arr.shape
-
-    driver = gdal.GetDriverByName("GTiff")
-    outdata = driver.Create(filledfile, rows, cols, 1, gdal.GDT_Int16)
-    outdata.SetGeoTransform(dem.GetGeoTransform())##sets same geotransform as input
-    outdata.SetProjection(dem.GetProjection())##sets same projection as input
-    outdata.GetRasterBand(1).WriteArray(filled)
-    outdata.GetRasterBand(1).SetNoDataValue(nodataval)##if you want these values transparent
-    outdata.FlushCache()
-    outdata = None
-
-def get_masks(feature_files, bad_data = 32767):
-    masks = {}
-    for key in feature_files.keys():
-        feature_dem_tmp = io.imread(feature_files[key])
-        masks[key] = feature_dem_tmp == bad_data
-    return masks
+    nodata = raster_io.raster_info(demfile)['nodata']
+    if nodata is None:
+        nodata = nodataval
+    raster_io.write_raster(filledfile, filled, demfile, window=window, nodata=nodata)
+
+'''
+Builds a single label raster for all of the features, reading the per-feature DEMs one at a time.
+Pixels of the n-th feature in feature_files are labeled n (starting from 1), and pixels outside all features are 0,
+so memory use is one small-integer raster however many features there are.
+
+feature_files = Dict with the names of the features as keys and the DEMs with that feature clipped as values
+bad_data = Value marking the clipped pixels in the feature DEMs
+window = (xoff, yoff, xsize, ysize) of the part of the DEMs to read. If None, the whole DEMs are read.
+
+Returns the label raster and the list of feature names, in label order.
+'''
+def get_labels(feature_files, bad_data = 32767, window=None):
+    label_names = list(feature_files.keys())
+    labels = None
+    for i, key in enumerate(label_names):
+        feature_mask = raster_io.read_raster(feature_files[key], window=window) == bad_data
+        if labels is None:
+            labels = np.zeros(feature_mask.shape, dtype=label_dtype(len(label_names)))
+        n_overlap = np.count_nonzero(labels[feature_mask])
+        if n_overlap > 0:
+            print('Warning: '+str(n_overlap)+' pixels of '+key+' are also in another feature. They will be counted in '+key)
+        labels[feature_mask] = i + 1
+    return labels, label_names
+
+#Extensions of the vector files that do_calc_vol reads feature polygons from
+VECTOR_EXTENSIONS = ('.geojson', '.json', '.shp', '.gpkg')
+
+#Returns true if dem_feature_files is a single vector file of feature polygons, rather than per-feature DEMs
+def is_vector_file(dem_feature_files):
+    return isinstance(dem_feature_files, str) and dem_feature_files.lower().endswith(VECTOR_EXTENSIONS)
+
+'''
+Builds the label raster from a vector file (GeoJSON, Shapefile or GeoPackage) of fan and catchment polygons, by
+rasterizing the polygons in memory on the grid of the DEM. This replaces the per-feature clipped DEMs: no feature DEMs
+have to be exported or read.
+
+feature_file = Vector file with one or more polygons per feature
+demfile = DEM whose grid the polygons are rasterized onto
+name_field = Attribute with the name of the feature each polygon belongs to, e.g. 'Fan_1'
+match_field = Attribute with, for each fan, the name of its matching catchment. Leave it empty for catchments.
+window = (xoff, yoff, xsize, ysize) of the part of the DEM to use. If None, the whole DEM is used.
+
+Returns the label raster, the list of feature names in label order (see get_labels), and the fan_catchment_match dict
+built from match_field.
+'''
+def get_vector_labels(feature_file, demfile, name_field='name', match_field='match', window=None):
+    print('Rasterizing feature polygons from '+feature_file)
+    labels, label_names, attributes = raster_io.rasterize_polygons(feature_file, demfile, name_field=name_field,
+                                                                   window=window)
+    fan_catchment_match = {}
+    for name, items in zip(label_names, attributes):
+        match = items.get(match_field)
+        if match is not None and str(match).strip() != '':
+            if str(match) not in label_names:
+                raise ValueError('Fan '+name+' is matched to catchment '+str(match)+', which is not in '+feature_file)
+            fan_catchment_match[name] = str(match)
+    return labels.astype(label_dtype(len(label_names)), copy=False), label_names, fan_catchment_match
+
+#Returns the smallest unsigned integer type that can hold labels for n features
+def label_dtype(n):
+    return np.uint8 if n < np.iinfo(np.uint8).max else np.uint16
+
+#Converts a dict of boolean masks, one per feature, into a label raster and list of feature names.
+def masks_to_labels(masks):
+    label_names = list(masks.keys())
+    labels = None
+    for i, key in enumerate(label_names):
+        if labels is None:
+            labels = np.zeros(masks[key].shape, dtype=label_dtype(len(label_names)))
+        labels[masks[key]] = i + 1
+    return labels, label_names
+
+#Reads a label raster saved with write_labels (or made in a GIS), where feature n of label_names has the value n.
+def read_labels(label_file, label_names, window=None):
+    labels = raster_io.read_raster(label_file, window=window)
+    return labels.astype(label_dtype(len(label_names)), copy=False), list(label_names)
+
+#Saves a label raster with the georeferencing of the DEM, so it can be loaded directly with read_labels next time.
+def write_labels(label_file, labels, demfile, window=None):
+    print('Saving '+label_file)
+    raster_io.write_raster(label_file, labels, demfile, window=window, nodata=0, dtype=labels.dtype)
 
 '''
 This function calls the different methods for filling in the gaps in a DEM that has been 'clipped'
@@ -46,90 +115,311 @@ method = Which interpolation method to use. See do_calc_vol for more details.
 cratername = Name of the crater used in output files.
 outpath = Directory in which to save results.
 savefigs = Set to true to save png figures of the stages of the DEM filling.
+vectorized = Set to true to fill all annuli (or radial lines) at once with array operations instead of one at a time
+             in a loop. Only used by the 'annular' and 'radial' methods. Gives identical results, but much faster.
+local = Set to true to fill each hole from a ring of pixels around it for the 'linear' and 'cubic' methods, instead
+        of interpolating from every pixel in the DEM. Much faster, with results close to the whole-image interpolation.
+sparse = Set to true to calculate the fill only at the clipped pixels for the 'annular', 'radial' and profile methods,
+         interpolating the filled polar image (or profile) at each pixel's radius and angle, instead of re-wrapping the
+         whole polar image back to the size of the DEM. Pixels outside the holes keep their original values.
+polar_grid = PolarGrid with precalculated lookup tables for converting to and from polar coordinates. If None, one is
+             looked up with polar_grid.get_polar_grid, so that methods run on the same DEM share it. Set to False to
+             call cv2.warpPolar directly, e.g. when the grid will only be used once.
+adaptive = Set to true to run the 'annular', 'radial' and profile methods on an adaptive polar grid (see
+           polar_grid.AdaptivePolarGrid), whose number of angular steps grows with radius so that each sample covers
+           about one DEM pixel, instead of the fixed rsize x tsize grid. Only the clipped pixels are filled, as with
+           sparse. rsize and tsize are not used.
+max_radius = Largest radius of the adaptive grid in pixels. Defaults to the distance to the farthest corner of the DEM.
+low_memory = Set to true to use less memory without changing the results: cv2.warpPolar is called directly instead of
+             making a PolarGrid (unless one is given), and the profile statistics are calculated in float32 instead of
+             float64, when that holds every value of the DEM exactly (e.g. int16 or float32 DEMs).
+in_place = Set to true to fill the holes of dem_clipped itself, instead of a copy, where the method allows it (every
+           method except the re-wrapped 'annular' and 'radial' fills, which make a new DEM anyway). The filled DEM is
+           then dem_clipped, so the caller has to set the holes back to bad_data before filling it again.
                
 '''
 def fill_dem(dem_clipped, crater_center, rsize, tsize, bad_data = 32767, method = 'annular',
-             cratername='crater', outpath='', savefigs=True):
+             cratername='crater', outpath='', savefigs=True, vectorized=False, local=False,
+             polar_grid=None, sparse=False, adaptive=False, max_radius=None, low_memory=False, in_place=False):
+    polar_method = method in ['annular', 'radial'] or dem_interp.is_profile_method(method)
+    if adaptive and polar_method:
+        grid = get_adaptive_polar_grid(dem_clipped.shape, crater_center, max_radius)
+        return dem_interp.dem_interp_adaptive(dem_clipped, grid, method=method, bad_data_value=bad_data,
+                                              cratername=cratername, outpath=outpath, savefigs=savefigs,
+                                              dtype=profile_dtype(dem_clipped, low_memory), in_place=in_place)
+
+    if polar_grid is None and polar_method and not low_memory:
+        #the sparse fills never re-wrap, so they don't need the re-wrapping tables
+        polar_grid = get_polar_grid(dem_clipped.shape, crater_center, rsize, tsize, inverse=not sparse)
+    elif polar_grid is False:
+        polar_grid = None
+
     if method == 'annular':
         dem_filled = dem_interp.dem_interp_annular(dem_clipped, crater_center, rsize, tsize, bad_data_value=bad_data,
-                                                   cratername=cratername, outpath=outpath, savefigs=savefigs)
+                                                   cratername=cratername, outpath=outpath, savefigs=savefigs,
+                                                   vectorized=vectorized, polar_grid=polar_grid,
+                                                  sparse=sparse, in_place=in_place)
 
     if method == 'radial':
         dem_filled = dem_interp.dem_interp_radial(dem_clipped, crater_center, rsize, tsize, bad_data_value=bad_data,
-                                                  cratername=cratername,outpath=outpath,savefigs=savefigs)
-    if method == 'cubic':
+                                                  cratername=cratername,outpath=outpath,savefigs=savefigs,
+                                                  vectorized=vectorized, polar_grid=polar_grid,
+                                                  sparse=sparse, in_place=in_place)
+    if method in ['cubic', 'linear'] and local:
+        dem_filled = dem_interp.dem_interp_local(dem_clipped, method=method, bad_data_value=bad_data,
+                                                 cratername=cratername,outpath=outpath,savefigs=savefigs,
+                                                 in_place=in_place)
+    elif method == 'cubic':
         dem_filled = dem_interp.dem_interp(dem_clipped, method=method, bad_data_value=bad_data,
-                                           cratername=cratername,outpath=outpath,savefigs=savefigs)
-    if method == 'linear':
+                                           cratername=cratername,outpath=outpath,savefigs=savefigs,
+                                           in_place=in_place)
+    elif method == 'linear':
         dem_filled = dem_interp.dem_interp(dem_clipped, method=method, bad_data_value=bad_data,
-                                           cratername=cratername,outpath=outpath,savefigs=savefigs)
-    if method == 'mean':
-        dem_filled = dem_interp.dem_interp_profile(dem_clipped, crater_center,rsize, tsize, bad_data_value=bad_data,
-                                                       profile_type=method, cratername=cratername,
-                                                        outpath=outpath,savefigs=savefigs)
-    if method == 'min':
-        dem_filled = dem_interp.dem_interp_profile(dem_clipped, crater_center, rsize, tsize, bad_data_value=bad_data,
-                                                   profile_type=method, cratername=cratername,
-                                                   outpath=outpath, savefigs=savefigs)
-    if method == 'median':
+                                           cratername=cratername,outpath=outpath,savefigs=savefigs,
+                                           in_place=in_place)
+    if dem_interp.is_profile_method(method):
         dem_filled = dem_interp.dem_interp_profile(dem_clipped, crater_center, rsize, tsize, bad_data_value=bad_data,
                                                    profile_type=method, cratername=cratername,
-                                                   outpath=outpath, savefigs=savefigs)
-    if method == 'max':
-        dem_filled = dem_interp.dem_interp_profile(dem_clipped, crater_center, rsize, tsize, bad_data_value=bad_data,
-                                                   profile_type=method, cratername=cratername,
-                                                   outpath=outpath, savefigs=savefigs)
+                                                   outpath=outpath, savefigs=savefigs, polar_grid=polar_grid,
+                                                   sparse=sparse, dtype=profile_dtype(dem_clipped, low_memory),
+                                                   in_place=in_place)
 
     return dem_filled
 
 
+#Returns the floating point type for the profile statistics of a DEM: float32 in low-memory mode if it holds every
+#value of the DEM's type exactly, otherwise float64
+def profile_dtype(dem, low_memory=False):
+    if low_memory and np.result_type(dem.dtype, np.float32) == np.float32:
+        return np.float32
+    return float
+
+'''
+Fills the DEM with several profile methods at once (e.g. ['mean', 'median', 'q10', 'q90']), unwrapping the DEM and
+sorting each radius's samples only once (see dem_interp.iter_profile_fills). The other inputs are as for fill_dem.
+
+Yields (method, filled DEM) pairs in the order of profile_types. Each filled DEM is only made when the next pair is
+asked for, so only one of them needs to be held in memory at a time. With in_place, every filled DEM is dem_clipped.
+'''
+def fill_dem_profiles(dem_clipped, crater_center, rsize, tsize, profile_types, bad_data = 32767, cratername='crater',
+                      outpath='', savefigs=True, polar_grid=None, sparse=False, adaptive=False, max_radius=None,
+                      low_memory=False, in_place=False):
+    if adaptive:
+        grid = get_adaptive_polar_grid(dem_clipped.shape, crater_center, max_radius)
+        return dem_interp.iter_adaptive_profile_fills(dem_clipped, grid, profile_types=profile_types,
+                                                      bad_data_value=bad_data, cratername=cratername,
+                                                      outpath=outpath, savefigs=savefigs,
+                                                      dtype=profile_dtype(dem_clipped, low_memory), in_place=in_place)
+    if polar_grid is None and not low_memory:
+        polar_grid = get_polar_grid(dem_clipped.shape, crater_center, rsize, tsize, inverse=not sparse)
+    elif polar_grid is False:
+        polar_grid = None
+    return dem_interp.iter_profile_fills(dem_clipped, crater_center, rsize, tsize, bad_data_value=bad_data,
+                                         profile_types=profile_types, cratername=cratername, outpath=outpath,
+                                         savefigs=savefigs, polar_grid=polar_grid, sparse=sparse,
+                                         dtype=profile_dtype(dem_clipped, low_memory), in_place=in_place)
+
+
 '''
 This script is the one that actually calculates the volumes.
 
 dem = Original (non-clipped) DEM
 dem_filled = DEM with clipped features filled in by one of the interpolation methods.
-masks = Dict with masks for each feature, indicating which pixels in the DEM correspond to that feature
+labels = Label raster with the feature number of each pixel in the DEM (0 for no feature), from get_labels
+label_names = List with the name of each feature, in label order (label 1 is label_names[0])
 fan_catchment_match = Dict with keys for each fan and values for each corresponding catchment.
 pixel_size = Physical size of the DEM pixels. Defaults to 20.0 meters. 
+
+The volumes of all features are summed in a single pass over the labeled pixels, in float64.
 '''
-def find_volumes(dem, dem_filled, masks, fan_catchment_match, pixel_size = 20.0):
+def find_volumes(dem, dem_filled, labels, label_names, fan_catchment_match, pixel_size = 20.0):
     print('Calculating volumes. Pixel size: '+str(pixel_size))
-    filled_fan = copy.copy(dem_filled)
-    filled_catchment = copy.copy(dem_filled)
+    fans = fan_catchment_match.keys()
+    catchments = [fan_catchment_match[key] for key in fan_catchment_match.keys()]
 
-    # For fans, use original DEM values where fan is lower than the inferred surface
-    filled_fan[dem < filled_fan] = dem[dem < filled_fan]
-    diff_fan = dem - filled_fan
+    # Only the pixels inside features are needed
+    in_feature = np.flatnonzero(labels)
+    feature_labels = labels.ravel()[in_feature]
+    diff = dem.ravel()[in_feature].astype(np.float64) - dem_filled.ravel()[in_feature]
 
-    # For catchments, use original DEM values where catchment is higher than the inferred surface
-    filled_catchment[dem>filled_catchment]=dem[dem>filled_catchment]
-    diff_catchment = filled_catchment - dem
+    # For fans, count where the fan is higher than the inferred surface.
+    # For catchments, count where the catchment is lower than the inferred surface.
+    is_fan = np.array([False] + [key in fans for key in label_names])
+    heights = np.where(is_fan[feature_labels], np.maximum(diff, 0), np.maximum(-diff, 0))
+    sums = np.bincount(feature_labels, weights=heights, minlength=len(label_names) + 1)
 
-    # Create empty dict to hold volumes
+    # Create dict to hold the volume of each fan and catchment
     volumes = {}
-    # Get all feature names, mask names, and catchment names
-    mask_keys = masks.keys()
-    fans = fan_catchment_match.keys()
-    catchments = [fan_catchment_match[key] for key in fan_catchment_match.keys()]
+    for i, key in enumerate(label_names):
+        if key in fans or key in catchments:
+            volumes[key] = pixel_size*pixel_size*sums[i + 1]/1e9
+
+    return volumes
+
 
-    #calculate volumes for each feature
-    for key in mask_keys:
-        if key in fans:
-            volumes[key] = pixel_size*pixel_size*np.sum(diff_fan[masks[key]])/1e9
-        elif key in catchments:
-            volumes[key] = pixel_size*pixel_size*np.sum(diff_catchment[masks[key]])/1e9
+#The peak resident memory of a run is higher than the largest total of the arrays that are alive at once, since memory
+#that is freed isn't always given back to the system straight away, so the estimates are scaled up by this factor.
+MEMORY_MARGIN = 1.25
+
+'''
+Estimates the memory in bytes used by the calculation, from the sizes of the arrays it makes. Each fill is split into
+steps (unwrapping, filling, re-wrapping or sampling, finding the volumes), and the memory of a group of methods is that
+of its largest step. The sizes were checked against the peak memory of real runs, and are scaled by MEMORY_MARGIN.
+
+shape, dtype = Shape and data type of the DEM
+n_holes = Number of clipped pixels
+n_labeled = Number of pixels inside features
+groups = Groups of methods that are run together (see do_calc_vol)
+rsize, tsize = Size of the polar images
+label_itemsize = Bytes per pixel of the label raster
+sparse, local, adaptive, low_memory = As for fill_dem. With low_memory, the holes are also filled in place (see
+                                      do_calc_vol), so most methods don't make a filled copy of the DEM.
+max_radius = Largest radius of the adaptive grid. Defaults to the length of the DEM's diagonal.
+polar_tables = Set to false if the polar fills call cv2.warpPolar directly instead of sharing a PolarGrid
+
+Returns the memory of the inputs and polar lookup tables that are kept for the whole run, the extra memory needed for
+a short time while they are made, and a list with the extra memory needed while each group of methods runs.
+'''
+def estimate_memory(shape, dtype, n_holes, n_labeled, groups, rsize, tsize, label_itemsize=1, sparse=False,
+                    local=False, adaptive=False, low_memory=False, max_radius=None, polar_tables=True):
+    n_pixels = int(shape[0])*int(shape[1])
+    itemsize = np.dtype(dtype).itemsize
+    index_itemsize = 4 if n_pixels < np.iinfo(np.int32).max else 8
+    stat_itemsize = np.dtype(profile_dtype(np.empty(0, dtype), low_memory)).itemsize
+    methods = [method for group in groups for method in group]
+    uses_polar = any(method in ['annular', 'radial'] or dem_interp.is_profile_method(method) for method in methods)
+    polar_tables = polar_tables and uses_polar and not adaptive
+    if adaptive:
+        if max_radius is None:
+            max_radius = np.hypot(shape[0], shape[1])
+        n_polar = int(1.25*np.pi*max_radius**2)
+        #the outermost band, which holds about a third of the samples
+        n_band = n_polar//3
+    else:
+        n_polar = int(rsize)*int(tsize)
+    #pixels in each chunk of periodic_interp_columns, and in each block of rows re-wrapped by cv2.warpPolar
+    interp_temp = min(n_polar, dem_interp.INTERP_CHUNK_SIZE)*8*5
+    block_pixels = min(int(shape[0]), dem_interp.REWRAP_BLOCK_ROWS)*int(shape[1])
+
+    #original and clipped DEMs and the label raster
+    base = n_pixels*(2*itemsize + label_itemsize)
+    #reading one feature DEM and its mask while the label raster is built
+    setup = n_pixels*(itemsize + 1)
+    if adaptive and uses_polar:
+        #band index tables and validity masks, and the coordinates of the largest band while they are made
+        base += n_polar*(1 + index_itemsize)
+        setup = max(setup, n_band*8*4)
+    elif polar_tables:
+        #polar lookup tables (validity masks and indices), and the index images they are built from
+        base += n_polar*(1 + index_itemsize)
+        setup = max(setup, n_pixels*4*3 + n_polar*(4*2 + index_itemsize))
+        if not sparse:
+            base += n_pixels*(1 + index_itemsize)
+            setup = max(setup, n_polar*4*3 + n_pixels*(4*2 + index_itemsize))
+
+    #the filled DEM, unless the holes are filled in place
+    filled = 0 if low_memory else n_pixels*itemsize
+    #labeled pixel mask, and the indices, differences and heights of the labeled pixels in find_volumes
+    volumes = n_pixels + n_labeled*8*6
+    #hole mask
+    mask = n_pixels
+    #the temporaries of sampling a polar image at the holes (sample_polar or AdaptivePolarGrid.sample)
+    sample = n_holes*8*24
+    group_memory = []
+    for group in groups:
+        method = group[0]
+        polar_method = method in ['annular', 'radial'] or dem_interp.is_profile_method(method)
+        #the re-wrapped 'annular' and 'radial' fills always make a new DEM
+        out = n_pixels*itemsize if method in ['annular', 'radial'] and not (sparse or adaptive) else filled
+        steps = [out + volumes]
+        if adaptive and polar_method:
+            bands = n_polar*itemsize
+            steps.append(mask + bands + n_polar)
+            if method == 'annular':
+                steps.append(mask + bands + n_band*(itemsize + 1) + interp_temp)
+            elif method == 'radial':
+                #every band resampled to the angles of the outermost band, which has about 2*pi*max_radius of them
+                fine = int(2*np.pi*max_radius**2)
+                steps.append(mask + bands + fine*(2*itemsize + 1) + interp_temp)
+            else:
+                steps.append(mask + bands + n_band*(stat_itemsize + 1))
+            steps.append(mask + bands + sample + out)
+        elif polar_method:
+            polar = n_polar*itemsize
+            #the profile fills find the hole mask first, and keep it
+            held = 0 if method in ['annular', 'radial'] else mask
+            #unwrapping with the lookup tables, or with the coordinate maps that cv2.warpPolar makes
+            steps.append(held + polar + (n_polar*index_itemsize if polar_tables else n_polar*4*2))
+            if method in ['annular', 'radial']:
+                #bad data mask and the interpolation temporaries
+                steps.append(polar + n_polar + interp_temp)
+                if sparse:
+                    steps.append(polar + mask + sample + out)
+                else:
+                    #re-wrapped with the lookup tables, or a block of rows at a time
+                    steps.append(polar + out + (n_pixels*index_itemsize if polar_tables else
+                                                block_pixels*(4*2 + itemsize)))
+            else:
+                #the sorted floating point copy of the polar image and its bad data mask
+                steps.append(mask + polar + n_polar*(stat_itemsize + 1))
+                #the radius of each hole pixel's polar pixel
+                if sparse:
+                    radii = n_holes*8*6
+                elif polar_tables:
+                    radii = n_holes*(1 + index_itemsize + 8)
+                else:
+                    radii = n_polar*4 + block_pixels*(4*2 + 4) + n_holes*(4 + 1 + 8)
+                steps.append(mask + radii)
+                steps.append(mask + n_holes*8*4 + out)
+        elif local:
+            #hole labels, and a small griddata for each hole in each thread
+            hole_label_itemsize = 2 if n_holes <= np.iinfo(np.uint16).max else 4
+            steps.append(mask + n_pixels*hole_label_itemsize + n_holes*8*24 + out)
+        else:
+            #griddata over every good pixel of the DEM
+            steps.append(mask + n_pixels*8*10 + out)
+        group_memory.append(int(MEMORY_MARGIN*max(steps)))
+    return int(MEMORY_MARGIN*base), int(MEMORY_MARGIN*setup), group_memory
+
+'''
+Decides how many groups of methods can run at the same time within a memory budget.
 
-    return diff_fan, diff_catchment, volumes
+base, setup, group_memory = Estimated memory from estimate_memory
+workers = Largest number of groups to run at once
+memory_budget_mb = Memory budget in MB. If None, workers groups are run at once.
 
+Returns the number of groups to run at once, and the projected peak memory in bytes.
+'''
+def plan_memory(base, setup, group_memory, workers, memory_budget_mb=None):
+    workers = max(1, min(workers or 1, len(group_memory)))
+    largest = sorted(group_memory, reverse=True)
+
+    #groups run one at a time reuse the memory freed after the setup. Threads allocate from memory pools of their own,
+    #so groups run in threads don't.
+    def peak(workers):
+        if workers == 1:
+            return base + max(setup, largest[0])
+        return base + setup + sum(largest[:workers])
+
+    if memory_budget_mb is not None:
+        while workers > 1 and peak(workers) > memory_budget_mb*1e6:
+            workers -= 1
+    return workers, peak(workers)
 
 '''
 Script for calculating the volume of catchments/fans in craters
 
 Inputs: 
 dem_file = File containing the original DEM
-dem_clipped_file = File containing DEM with features to fill/measure "clipped" by setting to a nodata value
-dem_feature_files = Dict containing DEM files with individual features clipped, and the corresponding names ("keys")
-fan_catchment_match = Dict containing the names of fan features as keys and the name sof corresponding catchments as values
+dem_clipped_file = File containing DEM with features to fill/measure "clipped" by setting to a nodata value.
+                   Not needed (can be None) if dem_feature_files is a vector file.
+dem_feature_files = Dict containing DEM files with individual features clipped, and the corresponding names ("keys").
+                    If feature_label_file is given, this can instead be a list of the feature names, in label order.
+                    This can also be a single vector file (GeoJSON, Shapefile or GeoPackage) of the fan and catchment
+                    polygons. The polygons are rasterized on the DEM grid, and the clipped DEM is made from them, so
+                    only the original DEM is read (see get_vector_labels, name_field and match_field).
+fan_catchment_match = Dict containing the names of fan features as keys and the name sof corresponding catchments as values.
+                      If None and dem_feature_files is a vector file, it is taken from the match_field attribute.
 methods = List of methods to use for filling the DEM. Options include:
     'annular' = Topography is interpolated in annular rings 
     'radial' = Topography is interpolated radially
@@ -138,66 +428,296 @@ methods = List of methods to use for filling the DEM. Options include:
     'mean' = Profile calculated from the mean of topography at each radial distance
     'min' = Profile calculated from the min of topography at each radial distance
     'max' = Profile calculated from the max of topography at each radial distance
-crater_center = coordinates in the DEM image of the crater center. If set to None, this will trigger find_center.py, 
-                which lets the user click 10 points along the crater rim and fit a circle to get the center.
+    'q10', 'q25', ... = Profile calculated from a quantile (percentile) of topography at each radial distance
+    All of the profile methods in the list are calculated together, from a single unwrapping of the DEM.
+crater_center = coordinates in the DEM image of the crater center. If set to None, the center is found with
+                find_center.py, either automatically from the crater rim or by clicking points (see center_method).
 bad_data = Bad data value. Defaults to the ArcGIS default  of 32767
 pixel_size = Spatial size of the DEM pixels, used to give volumes in physical units. Defaults to 20.0 meters.
 outpath = Directory in which to save results.
 cratername = Name of the crater used in output files.
 savefigs = Set to true to save png figures of the stages of the DEM filling.
+vectorized = Set to true to use the vectorized (loop-free) versions of the 'annular' and 'radial' methods.
+sparse = Set to true to calculate the 'annular', 'radial' and profile fills only at the clipped pixels (see fill_dem).
+adaptive = Set to true to run the 'annular', 'radial' and profile fills on a polar grid whose angular resolution grows
+           with radius, so each sample covers about one DEM pixel (see fill_dem). The grid reaches the farthest corner of
+           the DEM, or 1.5 times the rim radius if the center was found automatically (but always past every clipped
+           pixel).
+local = Set to true to fill each hole from only the ring of pixels around it for the 'linear' and 'cubic' methods.
+feature_label_file = Label raster (see get_labels and write_labels) to load directly instead of building it from
+                     dem_feature_files. Feature n in dem_feature_files must have the value n in this raster.
+fig_dpi = Resolution of the saved figures.
+fig_preview_pixels = If given, DEMs are downsampled so neither side is longer than this before making figures.
+wait_for_figs = Figures are saved in background threads while the calculations continue. Set to true to wait until
+                they are all saved before returning. Otherwise call figure_writer.wait_for_figures() when they are needed.
+window = (xoff, yoff, xsize, ysize) in pixels of the part of the DEMs to read, e.g. from raster_io.crater_window.
+         Only this window is read from each file, so large mosaics do not have to be cropped by hand. crater_center
+         and the centers in the results are in pixels of the full DEM. If None, the whole DEMs are read.
+center_method = How to find the center if crater_center is None. 'auto' fits a circle to the crater rim found in the
+                DEM, without user input. 'click' lets the user click 10 points along the crater rim and fits a circle
+                to them. The score of the automatic fit is saved in the results (center_score).
+min_center_score = If the automatic center has a lower score than this, the user is asked to click the rim if
+                   click_fallback is true. Otherwise a ValueError is raised, so that no volumes are calculated around
+                   a wrong center (a batch run logs the crater as failed and goes on to the next one).
+click_fallback = Set to true to let the user click the rim when the automatic center has a low score.
+low_memory = Set to true to reduce the memory used without changing the results. The methods are run one at a time,
+             each filling the holes of the clipped DEM itself instead of a copy (see fill_dem). The polar fills call
+             cv2.warpPolar directly, a block of rows at a time, instead of sharing the DEM-sized lookup tables of a
+             PolarGrid. The profile statistics are calculated in float32 where that is exact. Calculating the fills
+             only at the clipped pixels (sparse) saves more memory, but changes the results, so it must be turned on
+             separately.
+memory_budget_mb = Memory budget in MB. The memory of the run is estimated from the sizes of the arrays it makes
+                   (see estimate_memory), and fewer methods are run at the same time (down to one at a time) when
+                   running workers of them at once would go over the budget. If even one at a time would go over the
+                   budget, low_memory is turned on. The projected peak memory and the actual peak (the rise in the
+                   resident memory of the process during the run) are printed, and saved in the run report if there
+                   is one.
+workers = Number of threads to run the methods in at the same time. Each thread runs a method's fill, GeoTIFF write
+          and volumes. The DEMs and labels are shared (read-only) by all of the threads, and the results are in the
+          same order as methods. If None, the methods are run one after another.
+name_field, match_field = Attributes of the polygons in a vector dem_feature_files with the name of each feature, and
+                          for fans, the name of the matching catchment.
+report = Set to true to record the wall time, CPU time and peak memory of each stage of the calculation for each
+         method, and save them to a _run_report.json file (see instrument.py).
+profile = Extra profiling for the report: 'cprofile' to save cProfile statistics to a _run_report.prof file, or
+          'tracemalloc' to also record the memory allocated by Python and numpy in each stage.
                
 
 '''
 def do_calc_vol(dem_file,dem_clipped_file, dem_feature_files, fan_catchment_match, methods, crater_center=None,
-                bad_data = 32767, pixel_size=20.0, outpath = '', cratername= 'crater', savefigs=True):
-
-    dem = io.imread(dem_file)
-    dem_clipped = io.imread(dem_clipped_file)
-    feature_masks = get_masks(dem_feature_files)
+                bad_data = 32767, pixel_size=20.0, outpath = '', cratername= 'crater', savefigs=True, vectorized=False,
+                window=None, feature_label_file=None, local=False, fig_dpi=1000, fig_preview_pixels=None,
+                wait_for_figs=False, report=False, profile=None, center_method='auto', min_center_score=0.5,
+                click_fallback=False, sparse=False, adaptive=False, name_field='name', match_field='match',
+                workers=None, low_memory=False, memory_budget_mb=None):
 
     if cratername is None:
         cratername = 'crater'
     print('Calculating fan and catchment volumes for crater named: '+cratername)
 
-    if crater_center == None:
-        print('No crater center provided! Click 10 points to fit a circle and find the center.')
-        crater_center = np.squeeze(find_center.circlefit(dem))
-    print('Crater center is '+str(crater_center))
-
-    results = pd.DataFrame(columns = ['crater','center_x','center_y','fan','fan_volume','catchment','catchment_volume','method'])
-
-    for i in np.arange(len(methods)):
-        rsize = int(np.sqrt(crater_center[0] ** 2 + crater_center[1] ** 2))  # number of radial steps
-        tsize = 1000  # number of angular steps
-
-        print('Filling gaps using method: ' + methods[i])
-        outstr = methods[i]
+    check_memory = low_memory or memory_budget_mb is not None
+    monitor = None
+    writer = None
+    #everything that is started here is stopped in the finally block, so that a crater that fails (e.g. in a batch)
+    #doesn't leave its report, memory monitor or figure writer running for the next one
+    try:
+        if check_memory:
+            monitor = instrument.MemoryMonitor().start()
+
+        if report:
+            instrument.start_report(profile=profile)
+        instrument.set_context(crater=cratername)
+
+        vector_features = is_vector_file(dem_feature_files)
+        with instrument.stage('read'):
+            dem = raster_io.read_raster(dem_file, window=window)
+            if not vector_features:
+                dem_clipped = raster_io.read_raster(dem_clipped_file, window=window)
+        with instrument.stage('mask build'):
+            if vector_features:
+                labels, label_names, vector_match = get_vector_labels(dem_feature_files, dem_file, name_field=name_field,
+                                                                      match_field=match_field, window=window)
+                if fan_catchment_match is None:
+                    fan_catchment_match = vector_match
+                #clip every feature out of the original DEM
+                dem_clipped = dem.copy()
+                dem_clipped[labels > 0] = bad_data
+            elif feature_label_file is None:
+                labels, label_names = get_labels(dem_feature_files, bad_data=bad_data, window=window)
+            else:
+                labels, label_names = read_labels(feature_label_file, dem_feature_files, window=window)
+
+        center_score = np.nan
+        rim_radius = None
+        if crater_center is None:
+            if center_method == 'auto':
+                print('No crater center provided! Finding the center from the crater rim.')
+                center_x, center_y, rim_radius, center_score = find_center.auto_center(dem, bad_data=bad_data)
+                crater_center = [center_x, center_y]
+                print('Center fit score: '+str(center_score))
+                if center_score < min_center_score and not click_fallback:
+                    #don't calculate volumes around a center that is probably wrong
+                    raise ValueError('The automatically found center of '+cratername+' has a score of '+
+                                     str(center_score)+', below min_center_score ('+str(min_center_score)+
+                                     '). Give crater_center, or use center_method=\'click\'.')
+            if center_method == 'click' or (center_score < min_center_score and click_fallback):
+                print('Click 10 points to fit a circle and find the center.')
+                crater_center = np.squeeze(find_center.circlefit(dem))
+                center_score = np.nan
+                rim_radius = None
+            if window is not None:
+                crater_center = [crater_center[0] + window[0], crater_center[1] + window[1]]
+        print('Crater center is '+str(crater_center))
+
+        #the center in pixels of the DEM window that was read
+        if window is None:
+            window_center = crater_center
+        else:
+            window_center = [crater_center[0] - window[0], crater_center[1] - window[1]]
+
+        #the adaptive grid only needs to reach a little past the rim, as long as it covers every clipped pixel
+        max_radius = None
+        if adaptive and rim_radius is not None:
+            rows, cols = np.nonzero(dem_clipped == bad_data)
+            hole_radius = np.max(np.hypot(cols - window_center[0], rows - window_center[1])) + 2 if len(rows) else 0
+            max_radius = min(bounds_radius(dem_clipped.shape, window_center), max(1.5*rim_radius, hole_radius))
+            del rows, cols
 
         if savefigs:
+            #save figures in the background, once each, while the calculations continue
+            writer = figure_writer.FigureWriter(dpi=fig_dpi, preview_pixels=fig_preview_pixels)
+            previous_writer = dem_interp.set_figure_writer(writer)
             dem_interp.save_dem_fig(dem,cratername+'_original.png',outpath,bad_data_value=bad_data)
 
-        dem_filled = fill_dem(dem_clipped, crater_center, rsize,tsize, bad_data=bad_data, method=methods[i],
-                        cratername=cratername,outpath=outpath,savefigs=savefigs)
-
-        #save the filled DEM with the same spatial information as the original DEM
-        basename = os.path.basename(dem_clipped_file).split('.')[0]
-        filledfile = outpath + basename + '_'+outstr + ".tif"
-        write_gdal(dem_file, dem_filled, filledfile)
-
-        #calculate the volumes using the difference between the original and filled DEMs
-        diff_fan, diff_catchment, volumes = find_volumes(dem, dem_filled, feature_masks, fan_catchment_match,
-                                                         pixel_size= pixel_size)
+        results = pd.DataFrame(columns = ['crater','center_x','center_y','fan','fan_volume','catchment','catchment_volume','method',
+                                          'center_score'])
 
-        #create a row of data for each fan/catchment pair for each method. Append it to the running list of results
-        for key in fan_catchment_match:
-            tmp = {'crater':[cratername],'center_x':[crater_center[0]],'center_y':[crater_center[1]],'fan':[key],
-                   'fan_volume':[volumes[key]],'catchment':[fan_catchment_match[key]],'catchment_volume':[volumes[fan_catchment_match[key]]],
-                   'method':[methods[i]]}
-            tmp_df = pd.DataFrame.from_dict(tmp)
-
-            results = pd.concat((results,tmp_df))
+        rsize = int(np.sqrt(window_center[0] ** 2 + window_center[1] ** 2))  # number of radial steps
+        tsize = 1000  # number of angular steps
 
-    #save the results out to a .csv
-    results.to_csv(outpath+cratername+'_cal_volume_results.csv')
+        #the profile methods are calculated together, in one group. Every other method is a group of its own.
+        profile_methods = list(dict.fromkeys(method for method in methods if dem_interp.is_profile_method(method)))
+        groups = []
+        for method in dict.fromkeys(methods):
+            if len(profile_methods) > 1 and method in profile_methods:
+                if profile_methods not in groups:
+                    groups.append(profile_methods)
+            else:
+                groups.append([method])
+
+        #the polar lookup tables take longer to make than one cv2.warpPolar call, so they are only worth making (and
+        #keeping) when more than one fill will use them. A group of profile methods is one fill, since it unwraps the
+        #DEM once. The adaptive fills use their own grid instead.
+        n_polar_fills = len([group for group in groups
+                             if group[0] in ['annular', 'radial'] or dem_interp.is_profile_method(group[0])])
+        share_grid = n_polar_fills > 1 and not adaptive
+
+        if check_memory:
+            n_holes = np.count_nonzero(dem_clipped == bad_data)
+            n_labeled = np.count_nonzero(labels)
+            grid_radius = bounds_radius(dem_clipped.shape, window_center) if max_radius is None else max_radius
+
+            #projects the peak memory, and how many groups to run at once, with or without low-memory mode
+            def project_memory(low_memory):
+                base, setup, group_memory = estimate_memory(dem_clipped.shape, dem_clipped.dtype, n_holes, n_labeled,
+                                                            groups, rsize, tsize, label_itemsize=labels.itemsize,
+                                                            sparse=sparse, local=local, adaptive=adaptive,
+                                                            low_memory=low_memory, max_radius=grid_radius,
+                                                            polar_tables=share_grid and not low_memory)
+                return plan_memory(base, setup, group_memory, 1 if low_memory else workers, memory_budget_mb)
+
+            workers, projected = project_memory(low_memory)
+            if memory_budget_mb is not None and projected > memory_budget_mb*1e6 and not low_memory:
+                low_workers, low_projected = project_memory(True)
+                print('The projected peak memory of {:.1f} MB is over the budget of {} MB, even running one method at '
+                      'a time. Switching to low-memory mode.'.format(projected/1e6, memory_budget_mb))
+                low_memory = True
+                workers, projected = low_workers, low_projected
+            print('Projected peak memory: {:.1f} MB, running {} group(s) of methods at a time'.format(projected/1e6,
+                                                                                                workers))
+            if memory_budget_mb is not None and projected > memory_budget_mb*1e6:
+                print('Warning: the projected peak memory is over the budget of '+str(memory_budget_mb)+' MB, even '
+                      'in low-memory mode')
+
+        shared_grid = None if share_grid and not low_memory else False
+        #in low-memory mode the methods run one at a time, so each fills the holes of dem_clipped itself, and they are
+        #put back before the next method
+        in_place = low_memory
+        if in_place:
+            hole_index = np.flatnonzero(dem_clipped == bad_data)
+
+        #fills, GeoTIFF writes and volumes for one group of methods. Returns a list of (method, volumes) pairs.
+        def run_group(group):
+            group_volumes = []
+            fills = None
+            for method in group:
+                print('Filling gaps using method: ' + method)
+                outstr = method
+                instrument.set_context(crater=cratername, method=method)
+
+                with instrument.stage('method total'):
+                    if len(group) > 1:
+                        #the profiles of the group are filled one at a time, as they are needed
+                        if fills is None:
+                            fills = fill_dem_profiles(dem_clipped, window_center, rsize, tsize, group, bad_data=bad_data,
+                                                      cratername=cratername, outpath=outpath, savefigs=savefigs,
+                                                      polar_grid=shared_grid, sparse=sparse, adaptive=adaptive,
+                                                      max_radius=max_radius, low_memory=low_memory,
+                                                      in_place=in_place)
+                        dem_filled = next(fills)[1]
+                    else:
+                        dem_filled = fill_dem(dem_clipped, window_center, rsize,tsize, bad_data=bad_data, method=method,
+                                        cratername=cratername,outpath=outpath,savefigs=savefigs, vectorized=vectorized,
+                                        local=local, polar_grid=shared_grid, sparse=sparse, adaptive=adaptive,
+                                        max_radius=max_radius, low_memory=low_memory, in_place=in_place)
+
+                    #save the filled DEM with the same spatial information as the original DEM
+                    basename = os.path.basename(dem_clipped_file or dem_file).split('.')[0]
+                    filledfile = outpath + basename + '_'+outstr + ".tif"
+                    with instrument.stage('GeoTIFF write'):
+                        write_gdal(dem_file, dem_filled, filledfile, nodataval=bad_data, window=window)
+
+                    #calculate the volumes using the difference between the original and filled DEMs
+                    with instrument.stage('volumes'):
+                        volumes = find_volumes(dem, dem_filled, labels, label_names, fan_catchment_match, pixel_size= pixel_size)
+                del dem_filled
+                if in_place:
+                    dem_clipped.flat[hole_index] = bad_data
+                group_volumes.append((method, volumes))
+            return group_volumes
+
+        if workers is None or workers <= 1 or len(groups) == 1 or low_memory:
+            group_results = [run_group(group) for group in groups]
+        else:
+            #the inputs are shared by all of the threads, so make sure none of them changes them
+            for arr in [dem, dem_clipped, labels]:
+                arr.flags.writeable = False
+            #make the polar grid once, before the threads would all try to make it at the same time
+            if adaptive and n_polar_fills > 0:
+                get_adaptive_polar_grid(dem_clipped.shape, window_center, max_radius)
+            elif shared_grid is None:
+                get_polar_grid(dem_clipped.shape, window_center, rsize, tsize, inverse=not sparse)
+            print('Running '+str(len(groups))+' groups of methods in '+str(workers)+' threads')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                group_results = list(pool.map(run_group, groups))
+        instrument.set_context(crater=cratername)
+
+        #create a row of data for each fan/catchment pair for each method, in the order the methods were given
+        method_volumes = dict(pair for group_result in group_results for pair in group_result)
+        for method in methods:
+            volumes = method_volumes[method]
+            for key in fan_catchment_match:
+                tmp = {'crater':[cratername],'center_x':[crater_center[0]],'center_y':[crater_center[1]],'fan':[key],
+                       'fan_volume':[volumes[key]],'catchment':[fan_catchment_match[key]],'catchment_volume':[volumes[fan_catchment_match[key]]],
+                       'method':[method],'center_score':[center_score]}
+                tmp_df = pd.DataFrame.from_dict(tmp)
+
+                results = pd.concat((results,tmp_df))
+
+        #save the results out to a .csv
+        results.to_csv(outpath+cratername+'_cal_volume_results.csv')
+
+        if check_memory:
+            monitor.stop()
+            if monitor.peak_mb is not None:
+                print('Peak memory: projected {:.1f} MB, actual {:.1f} MB'.format(projected/1e6,
+                                                                              monitor.peak_mb - monitor.start_mb))
+                instrument.record_memory(projected_peak_mb=projected/1e6, actual_peak_mb=monitor.peak_mb - monitor.start_mb,
+                                         memory_budget_mb=memory_budget_mb, method_threads=workers)
+    finally:
+        if monitor is not None:
+            monitor.stop()
+
+        if writer is not None:
+            dem_interp.set_figure_writer(previous_writer)
+            #the report should include the figures, so wait for them if there is one
+            writer.close(wait=wait_for_figs or report)
+
+        #the polar grids are the size of the DEM, so don't keep them once this crater is finished
+        clear_polar_grid_cache()
+
+        instrument.set_context()
+        if report:
+            instrument.finish_report(outpath+cratername+'_run_report.json')
 
     return results
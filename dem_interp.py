@@ -1,49 +1,302 @@
 import numpy as np
 import scipy.interpolate as interp
+import scipy.ndimage as ndimage
+import concurrent.futures
 import copy
-import matplotlib.pyplot as plot
+from matplotlib.figure import Figure
 import cv2
+import instrument
+
+#Figure writer used by save_dem_fig (see figure_writer.py). If None, figures are saved right away.
+figure_writer = None
+
+#Sets the figure writer used by save_dem_fig, and returns the previous one so it can be restored.
+def set_figure_writer(writer):
+    global figure_writer
+    previous = figure_writer
+    figure_writer = writer
+    return previous
+
+#Returns a copy of the dem, downsampled so that neither side is longer than preview_pixels (if given).
+def preview_copy(dem, preview_pixels=None):
+    if preview_pixels is None or max(dem.shape) <= preview_pixels:
+        return np.array(dem)
+    step = int(np.ceil(max(dem.shape) / preview_pixels))
+    return np.array(dem[::step, ::step])
 
 #This function saves the dem as a png for use as a figure.
-def save_dem_fig (dem_to_save, name, outpath, bad_data_value = [32767], colorbar=True):
+#If a figure writer has been set with set_figure_writer, the figure is handed to it to save in the background.
+#preview_pixels = If given, the dem is downsampled so neither side is longer than this before plotting.
+def save_dem_fig (dem_to_save, name, outpath, bad_data_value = [32767], colorbar=True, dpi=1000, preview_pixels=None):
+    if figure_writer is not None:
+        figure_writer.save(dem_to_save, name, outpath, bad_data_value=bad_data_value, colorbar=colorbar)
+        return
+    with instrument.stage('figure'):
+        write_dem_fig(preview_copy(dem_to_save, preview_pixels), name, outpath, bad_data_value=bad_data_value,
+                      colorbar=colorbar, dpi=dpi)
+
+#Plots and saves the dem. The dem is modified, so pass a copy. This uses matplotlib's object-oriented interface
+#instead of pyplot, so several figures can be saved at once from different threads.
+def write_dem_fig(dem_for_fig, name, outpath, bad_data_value = [32767], colorbar=True, dpi=1000):
     if not isinstance(bad_data_value,list):
         bad_data_value = [bad_data_value]
-    dem_for_fig = copy.deepcopy(dem_to_save)
     for bad in bad_data_value:
         dem_for_fig[dem_for_fig==bad] = np.max(dem_for_fig[dem_for_fig!=bad])
-    plot.imshow(dem_for_fig,cmap='viridis')
-    if colorbar: plot.colorbar(location='bottom')
-    fig = plot.gcf()
+    fig = Figure()
+    ax = fig.add_subplot()
+    im = ax.imshow(dem_for_fig,cmap='viridis')
+    if colorbar: fig.colorbar(im, ax=ax, location='bottom')
     fig.tight_layout()
-    ax = plot.gca()
     ax.set_xticks([])
     ax.set_yticks([])
-    fig.savefig(outpath+name, dpi=1000)
-    plot.close()
+    fig.savefig(outpath+name, dpi=dpi)
+
+
+#'Unwraps' the image into a rectangle where the axes are theta, radius.
+#If a PolarGrid is given, its precalculated lookup tables are used instead of calling cv2.warpPolar.
+def unwrap_polar(dem, center, rsize, tsize, polar_grid=None):
+    with instrument.stage('polar warp'):
+        if polar_grid is not None:
+            return polar_grid.unwrap(dem)
+        return cv2.warpPolar(dem,(rsize, tsize),(center[0], center[1]), maxRadius=rsize, flags=cv2.INTER_NEAREST)
+
+#Re-wraps a polar image back to x,y coordinates.
+#If a PolarGrid is given, its precalculated lookup tables are used instead of calling cv2.warpPolar.
+def rewrap_polar(polar_img, shape, center, rsize, polar_grid=None):
+    with instrument.stage('inverse warp'):
+        if polar_grid is not None:
+            return polar_grid.rewrap(polar_img)
+        #pixels with no polar pixel are set to 0, as with a PolarGrid
+        dem = np.empty(shape, dtype=polar_img.dtype)
+        for rows, block in inverse_warp_blocks(polar_img, shape, center, rsize, flags=cv2.WARP_FILL_OUTLIERS):
+            dem[rows] = block
+        return dem
+
+#Number of DEM rows re-wrapped by each cv2.warpPolar call in inverse_warp_blocks
+REWRAP_BLOCK_ROWS = 256
+
+'''
+Re-wraps a polar image back to x,y coordinates a block of rows at a time, with cv2.warpPolar and INTER_NEAREST.
+cv2.warpPolar makes a float32 x and y map the size of its output, i.e. 8 bytes per DEM pixel, so re-wrapping a block at
+a time keeps the maps small. Each block is made by moving the center up by the block's first row. cv2 rounds the center
+to float32 and subtracts it from each pixel's float32 coordinates. When the moved center is also exact in float32, each
+block gives the same pixels as one call for the whole DEM. If a block's moved center isn't exact, that block and all
+the rows below it are re-wrapped in one call.
+
+rows = Only the blocks with at least one of these rows are made (e.g. the rows with holes). Defaults to every row.
+flags = Extra cv2.warpPolar flags. Without cv2.WARP_FILL_OUTLIERS, DEM pixels with no polar pixel are not set.
+
+Yields (slice of rows, re-wrapped block) pairs, from the top of the DEM down.
+'''
+def inverse_warp_blocks(polar_img, shape, center, rsize, rows=None, flags=0):
+    center_x = float(np.float32(center[0]))
+    center_y = float(np.float32(center[1]))
+    needed = np.ones(shape[0], dtype=bool) if rows is None else np.isin(np.arange(shape[0]), rows)
+    start = 0
+    while start < shape[0]:
+        stop = min(start + REWRAP_BLOCK_ROWS, shape[0])
+        #the next block can only start where the moved center is exact, otherwise this block runs to the bottom
+        while stop < shape[0] and float(np.float32(center_y - stop)) != center_y - stop:
+            stop = shape[0]
+        if np.any(needed[start:stop]):
+            block = cv2.warpPolar(polar_img, (shape[1], stop - start), (center_x, center_y - start), maxRadius=rsize,
+                                  flags=cv2.INTER_NEAREST + cv2.WARP_INVERSE_MAP + flags)
+            yield slice(start, stop), block
+        start = stop
+
+'''
+Returns which polar pixel each of the masked DEM pixels comes from when a (tsize, rsize) polar image is re-wrapped
+with rewrap_polar, without re-wrapping a whole image: whether it comes from inside the polar image, and its radius
+step. Only the blocks of rows with masked pixels are re-wrapped (see inverse_warp_blocks).
+
+Returns the two arrays, in the order of the masked pixels in mask (as from dem[mask]).
+'''
+def polar_radii(mask, center, rsize, tsize):
+    #every row of the image holds its radius steps, offset by 1 so that 0 marks "no polar pixel"
+    radii = np.tile(np.arange(1, rsize + 1, dtype=np.float32), (tsize, 1))
+    hole_radii = []
+    for rows, block in inverse_warp_blocks(radii, mask.shape, center, rsize, rows=np.flatnonzero(np.any(mask, axis=1)),
+                                           flags=cv2.WARP_FILL_OUTLIERS):
+        hole_radii.append(block[mask[rows]])
+    hole_radii = np.concatenate(hole_radii).astype(np.int32) if hole_radii else np.zeros(0, dtype=np.int32)
+    return hole_radii > 0, np.maximum(hole_radii - 1, 0)
+
+'''
+Returns the polar coordinates (theta, radius) of DEM pixels, in units of the steps of a (tsize, rsize) polar image
+made with unwrap_polar, so that they can be looked up in the polar image directly.
+
+points = (rows, columns) of the pixels, e.g. from np.where(mask)
+'''
+def polar_coords(points, center, rsize, tsize):
+    dx = points[1] - center[0]
+    dy = points[0] - center[1]
+    r = np.hypot(dx, dy)
+    t = np.mod(np.arctan2(dy, dx), 2*np.pi) * tsize / (2*np.pi)
+    return t, r
+
+#Returns whether polar pixels (t, r) of a (tsize, rsize) polar image come from inside a DEM with the given shape.
+def polar_pixel_valid(t, r, shape, center, tsize):
+    angle = 2*np.pi*t/tsize
+    x = np.rint(center[0] + r*np.cos(angle))
+    y = np.rint(center[1] + r*np.sin(angle))
+    return (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0])
+
+'''
+Samples a filled polar image at the polar coordinates of some DEM pixels, with bilinear interpolation (wrapping
+around in theta). Only the given pixels are calculated, instead of re-wrapping the whole polar image, and the
+interpolation avoids the staircase pattern of nearest-neighbour re-wrapping. Polar pixels from outside the DEM, or
+still holding bad data, are left out of the interpolation. Pixels with no usable neighbours take the nearest
+polar pixel.
+
+polar_img = Filled (tsize, rsize) polar image
+points = (rows, columns) of the DEM pixels to sample, e.g. from np.where(mask)
+shape = Shape of the DEM
+polar_valid = Mask of the polar pixels that come from inside the DEM (e.g. PolarGrid.polar_valid). If None, this is
+              worked out for just the polar pixels that are needed.
+'''
+def sample_polar(polar_img, points, center, rsize, shape, polar_valid = None, bad_data_value = 32767):
+    tsize = polar_img.shape[0]
+    t, r = polar_coords(points, center, rsize, tsize)
+    r = np.minimum(r, rsize - 1)
+    r0 = np.floor(r).astype(np.intp)
+    r1 = np.minimum(r0 + 1, rsize - 1)
+    t0 = np.floor(t).astype(np.intp)
+    wr = r - r0
+    wt = t - t0
+    t0 = t0 % tsize
+    t1 = (t0 + 1) % tsize
+
+    total = np.zeros(r.shape)
+    weights = np.zeros(r.shape)
+    for tt, rr, w in [(t0, r0, (1-wt)*(1-wr)), (t0, r1, (1-wt)*wr), (t1, r0, wt*(1-wr)), (t1, r1, wt*wr)]:
+        values = polar_img[tt, rr].astype(np.float64)
+        if polar_valid is None:
+            valid = polar_pixel_valid(tt, rr, shape, center, tsize)
+        else:
+            valid = polar_valid[tt, rr]
+        w = np.where(valid & (values != bad_data_value), w, 0)
+        total += w*np.where(w > 0, values, 0)
+        weights += w
+
+    nearest = polar_img[np.rint(t).astype(np.intp) % tsize, np.rint(r).astype(np.intp)].astype(np.float64)
+    return np.where(weights > 0, total/np.where(weights > 0, weights, 1), nearest)
+
+#Fills the masked pixels of a copy of the DEM (or of the DEM itself, if in_place) with samples of the filled polar image
+def fill_from_polar(dem_with_holes, mask, polar_img, center, rsize, bad_data_value = 32767, polar_grid = None,
+                    in_place = False):
+    with instrument.stage('inverse warp'):
+        points = np.where(mask)
+        polar_valid = None if polar_grid is None else polar_grid.polar_valid
+        dem_filled = dem_with_holes if in_place else copy.copy(dem_with_holes)
+        dem_filled[points] = sample_polar(polar_img, points, center, rsize, dem_with_holes.shape, polar_valid,
+                                          bad_data_value)
+    return dem_filled
 
 
 #This function does 2D interpolation to fill in holes in teh DEM. This can be time-consuming and results can be unrealistic...
-def dem_interp(dem_with_holes, bad_data_value = 32767, method = 'cubic', cratername = 'crater', outpath='', savefigs = True):
+#in_place = Set to true to fill the holes of dem_with_holes itself, instead of a copy, e.g. to save memory.
+def dem_interp(dem_with_holes, bad_data_value = 32767, method = 'cubic', cratername = 'crater', outpath='', savefigs = True,
+               in_place = False):
 
     if savefigs: save_dem_fig(dem_with_holes, cratername + '_with_holes.png', outpath, bad_data_value=bad_data_value)
     mask = dem_with_holes == bad_data_value
     print('Interpolating: This can take a while!')
-    fill = interp.griddata(np.where(~mask), dem_with_holes[~mask], np.where(mask), method = method)
-    dem_filled = copy.copy(dem_with_holes)
-    dem_filled[mask] = fill
+    with instrument.stage('fill'):
+        fill = interp.griddata(np.where(~mask), dem_with_holes[~mask], np.where(mask), method = method)
+        dem_filled = dem_with_holes if in_place else copy.copy(dem_with_holes)
+        dem_filled[mask] = fill
+    if savefigs: save_dem_fig(dem_filled, cratername + '_filled_'+method+'.png', outpath, bad_data_value=bad_data_value)
+
+    return dem_filled
+
+
+#Labels the connected holes (including diagonal neighbours) in a mask, in a uint16 label image if there are few enough
+#holes to fit, which is half the size of the default int32 labels. Returns the label image and the number of holes.
+def label_holes(mask):
+    try:
+        holes = np.empty(mask.shape, dtype=np.uint16)
+        n_holes = ndimage.label(mask, structure=np.ones((3,3)), output=holes)
+        return holes, n_holes
+    except RuntimeError:
+        #too many holes for uint16
+        return ndimage.label(mask, structure=np.ones((3,3)))
+
+'''
+This function fills the holes in the DEM with 2D interpolation like dem_interp, but each hole is filled on its own
+using only a ring of good pixels around it, instead of triangulating every good pixel in the DEM. The holes are
+found by labeling the connected regions of bad data, and are filled in parallel.
+
+ring_width = Width in pixels of the ring of good pixels around each hole used for the interpolation. Cubic
+             interpolation estimates gradients from the ring, so a wider ring gives results closer to dem_interp.
+workers = Number of threads used to fill the holes. Defaults to the number of CPUs.
+in_place = Set to true to fill the holes of dem_with_holes itself, instead of a copy, e.g. to save memory.
+'''
+def dem_interp_local(dem_with_holes, bad_data_value = 32767, method = 'cubic', cratername = 'crater', outpath='',
+                     savefigs = True, ring_width = 5, workers = None, in_place = False):
+
+    if savefigs: save_dem_fig(dem_with_holes, cratername + '_with_holes.png', outpath, bad_data_value=bad_data_value)
+    mask = dem_with_holes == bad_data_value
+    holes, n_holes = label_holes(mask)
+    print('Interpolating '+str(n_holes)+' holes, each from the surrounding ring of pixels')
+    dem_filled = dem_with_holes if in_place else copy.copy(dem_with_holes)
+    context = instrument.get_context()
+
+    #each hole is recorded as a 'hole fill' stage of its own thread, since the CPU time of a stage only counts the
+    #thread that ran it (see instrument.py)
+    def fill_hole(hole_number, hole_slice):
+        instrument.set_context(**context)
+        with instrument.stage('hole fill'):
+            #expand the bounding box of the hole to include the ring around it
+            box = tuple(slice(max(s.start - ring_width, 0), s.stop + ring_width) for s in hole_slice)
+            hole = holes[box] == hole_number
+            ring = ndimage.binary_dilation(hole, structure=np.ones((3,3)), iterations=ring_width) & ~mask[box]
+            try:
+                fill = interp.griddata(np.where(ring), dem_with_holes[box][ring], np.where(hole), method = method)
+            except (RuntimeError, ValueError):
+                #too few ring pixels to triangulate (e.g. a hole in the corner of the DEM)
+                print('Could not interpolate hole #'+str(hole_number)+'! Not enough good pixels around it')
+                fill = np.full(np.count_nonzero(hole), np.nan)
+        return box, hole, fill
+
+    with instrument.stage('fill'), concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for box, hole, fill in pool.map(fill_hole, np.arange(1, n_holes + 1), ndimage.find_objects(holes)):
+            dem_filled[box][hole] = fill
+
     if savefigs: save_dem_fig(dem_filled, cratername + '_filled_'+method+'.png', outpath, bad_data_value=bad_data_value)
 
     return dem_filled
 
 
 #This function does linear interpolation along rings of constant radius to fill in the gaps in the DEM.
-def dem_interp_annular(dem_with_holes,center, rsize, tsize, bad_data_value = 32767, cratername = 'crater', outpath= '',  savefigs = True):
+def dem_interp_annular(dem_with_holes,center, rsize, tsize, bad_data_value = 32767, cratername = 'crater', outpath= '',  savefigs = True,
+                       vectorized = False, polar_grid = None, sparse = False, in_place = False):
     if savefigs: save_dem_fig (dem_with_holes, cratername+'_with_holes.png', outpath, bad_data_value = [bad_data_value])
 
     print("'Unwrapping' the image into a rectangle where the axes are theta, radius")
-    polar_img = cv2.warpPolar(dem_with_holes,(rsize, tsize),(center[0], center[1]), maxRadius=rsize, flags=cv2.INTER_NEAREST)
+    polar_img = unwrap_polar(dem_with_holes, center, rsize, tsize, polar_grid)
     if savefigs: save_dem_fig(polar_img, cratername+'_polar.png', outpath, bad_data_value=[bad_data_value,0],colorbar=False)
 
+    with instrument.stage('fill'):
+        if vectorized:
+            print('Interpolating all annuli at once')
+            polar_img = fill_annuli(polar_img, bad_data_value)
+        else:
+            polar_img = _fill_annuli_loop(polar_img, bad_data_value)
+
+    if sparse:
+        print('Sampling the filled image at the holes')
+        dem_filled = fill_from_polar(dem_with_holes, dem_with_holes == bad_data_value, polar_img, center, rsize,
+                                     bad_data_value=bad_data_value, polar_grid=polar_grid, in_place=in_place)
+    else:
+        print('Re-wrap the filled image back to x,y coordinates')
+        dem_filled = rewrap_polar(polar_img, dem_with_holes.shape, center, rsize, polar_grid)
+
+    if savefigs: save_dem_fig(dem_filled, cratername+'_filled_annular.png', outpath, bad_data_value=[bad_data_value,0])
+
+    return dem_filled
+
+#Original loop version of the annulus fill, kept for reference and comparison with the vectorized version.
+def _fill_annuli_loop(polar_img, bad_data_value):
     print('Interpolating each annulus')
     for r in np.arange(polar_img.shape[1]):
         annulus = polar_img[:,r]  #get one annulus
@@ -64,22 +317,37 @@ def dem_interp_annular(dem_with_holes,center, rsize, tsize, bad_data_value = 327
                 annulus = polar_img[:,r-1]
                 pass
             polar_img[:,r] = annulus
-
-    print('Re-wrap the filled image back to x,y coordinates')
-    dem_filled = cv2.warpPolar(polar_img,dem_with_holes.shape[::-1],(center[0],center[1]),maxRadius=rsize, flags=cv2.INTER_NEAREST+cv2.WARP_INVERSE_MAP)
-
-    if savefigs: save_dem_fig(dem_filled, cratername+'_filled_annular.png', outpath, bad_data_value=[bad_data_value,0])
-
-    return dem_filled
+    return polar_img
 
 #This function does linear interpolation along lines of constant angle to fill in the gaps in the DEM.
-def dem_interp_radial(dem_with_holes,center, rsize, tsize, bad_data_value = 32767, cratername = 'crater', outpath= '',  savefigs = True):
+def dem_interp_radial(dem_with_holes,center, rsize, tsize, bad_data_value = 32767, cratername = 'crater', outpath= '',  savefigs = True,
+                      vectorized = False, polar_grid = None, sparse = False, in_place = False):
     if savefigs: save_dem_fig(dem_with_holes, cratername + '_with_holes.png', outpath, bad_data_value=bad_data_value)
 
     print("'Unwrapping' the image into a rectangle where the axes are theta, radius")
-    polar_img = cv2.warpPolar(dem_with_holes,(rsize, tsize),(center[0], center[1]), maxRadius=rsize, flags=cv2.INTER_NEAREST)
+    polar_img = unwrap_polar(dem_with_holes, center, rsize, tsize, polar_grid)
     if savefigs: save_dem_fig(dem_with_holes, cratername + '_polar.png', outpath, bad_data_value=bad_data_value)
 
+    with instrument.stage('fill'):
+        if vectorized:
+            print('Interpolating all radial lines at once')
+            polar_img = fill_radial_lines(polar_img, bad_data_value)
+        else:
+            polar_img = _fill_radial_lines_loop(polar_img, bad_data_value)
+
+    if sparse:
+        print('Sampling the filled image at the holes')
+        dem_filled = fill_from_polar(dem_with_holes, dem_with_holes == bad_data_value, polar_img, center, rsize,
+                                     bad_data_value=bad_data_value, polar_grid=polar_grid, in_place=in_place)
+    else:
+        print('Re-wrap the filled image back to x,y coordinates')
+        dem_filled = rewrap_polar(polar_img, dem_with_holes.shape, center, rsize, polar_grid)
+    if savefigs: save_dem_fig(dem_filled, cratername + '_filled_radial.png', outpath, bad_data_value=bad_data_value)
+
+    return dem_filled
+
+#Original loop version of the radial fill, kept for reference and comparison with the vectorized version.
+def _fill_radial_lines_loop(polar_img, bad_data_value):
     print('Interpolating each radial line')
     for t in np.arange(polar_img.shape[0]):
         radius = polar_img[t,:]
@@ -93,50 +361,338 @@ def dem_interp_radial(dem_with_holes,center, rsize, tsize, bad_data_value = 3276
             else:
                 pass
             polar_img[t,:] = radius
+    return polar_img
 
+#Number of pixels interpolated at a time by periodic_interp_columns
+INTERP_CHUNK_SIZE = 2**18
 
-    print('Re-wrap the filled image back to x,y coordinates')
-    dem_filled = cv2.warpPolar(polar_img,dem_with_holes.shape[::-1],(center[0],center[1]),maxRadius=rsize, flags=cv2.INTER_NEAREST+cv2.WARP_INVERSE_MAP)
-    if savefigs: save_dem_fig(dem_filled, cratername + '_filled_radial.png', outpath, bad_data_value=bad_data_value)
+'''
+Periodic linear interpolation of the bad pixels in every column of a 2D array at once (interpolating along axis 0).
+For each bad pixel the nearest good pixels before and after it in its column are found with cumulative max/min
+index scans, wrapping around the ends of the column. The interpolation uses the same arithmetic as
+np.interp(..., period=img.shape[0]), so the result is bit-identical to calling np.interp column by column.
+The columns are done chunk_size pixels at a time, so the index scans never need more than a few arrays of that size.
 
-    return dem_filled
+img = 2D array to fill. It is modified in place and returned.
+bad = Boolean array, same shape as img, flagging the pixels to fill.
+cols = Boolean array with one entry per column, flagging which columns to fill. Every column in cols must have at
+       least one good pixel.
+'''
+def periodic_interp_columns(img, bad, cols, chunk_size=INTERP_CHUNK_SIZE):
+    n = img.shape[0]
+    col_idx = np.flatnonzero(cols)
+    chunk_cols = max(1, chunk_size // max(n, 1))
+    for start in range(0, col_idx.size, chunk_cols):
+        _periodic_interp_chunk(img, bad, col_idx[start:start + chunk_cols])
+    return img
+
+#periodic_interp_columns for the columns in col_idx
+def _periodic_interp_chunk(img, bad, col_idx):
+    n = img.shape[0]
+    sub_bad = bad[:, col_idx]
+    rows = np.arange(n)[:, None]
+
+    #index of the previous good pixel in each column, wrapping to (last good pixel - period) before the first one
+    prev_good = np.maximum.accumulate(np.where(sub_bad, -1, rows), axis=0)
+    prev_good = np.where(prev_good < 0, prev_good[-1] - n, prev_good)
+
+    #index of the next good pixel in each column, wrapping to (first good pixel + period) after the last one
+    next_good = np.minimum.accumulate(np.where(sub_bad, 2*n, rows)[::-1], axis=0)[::-1]
+    next_good = np.where(next_good >= 2*n, next_good[0] + n, next_good)
+
+    #only the bad pixels need to be evaluated
+    r, c = np.nonzero(sub_bad)
+    del sub_bad
+    x0 = prev_good[r, c]
+    x1 = next_good[r, c]
+    del prev_good, next_good
+    cols_full = col_idx[c]
+    y0 = img[x0 % n, cols_full].astype(np.float64)
+    y1 = img[x1 % n, cols_full].astype(np.float64)
+    x0 = x0.astype(np.float64)
+    x1 = x1.astype(np.float64)
+    x = r.astype(np.float64)
+
+    #same operations, in the same order, as numpy's interp
+    slope = (y1 - y0) / (x1 - x0)
+    fill = slope*(x - x0) + y0
+    nan_fill = np.isnan(fill)
+    if np.any(nan_fill):
+        retry = slope*(x - x1) + y1
+        retry = np.where(np.isnan(retry) & (y0 == y1), y0, retry)
+        fill = np.where(nan_fill, retry, fill)
+
+    img[r, cols_full] = fill
+
+'''
+Vectorized version of the annulus fill: every annulus (column of the polar image) is interpolated at once.
+Follows the same rules as the loop version: annuli with 5 or fewer good pixels are replaced by the previous
+annulus, and annuli with no bad data are left unchanged. The output is bit-identical to _fill_annuli_loop.
+
+previous_annulus = Annulus to copy into the first annuli if they have too little good data. Defaults to the last
+                   annulus of polar_img, as in the loop version.
+'''
+def fill_annuli(polar_img, bad_data_value, previous_annulus=None):
+    bad = polar_img == bad_data_value
+    n_bad = np.sum(bad, axis=0)
+    n_good = polar_img.shape[0] - n_bad
+    interp_cols = (n_bad > 0) & (n_good > 5)
+    copy_cols = (n_bad > 0) & (n_good <= 5)
+
+    #the loop version copies polar_img[:,-1] into the first annulus before the last annulus has been filled
+    last_annulus = polar_img[:, -1].copy() if previous_annulus is None else previous_annulus
+
+    polar_img = periodic_interp_columns(polar_img, bad, interp_cols)
+
+    if np.any(copy_cols):
+        print('No good data in '+str(np.sum(copy_cols))+' annuli! Use the previous annulus')
+        #each annulus without enough good data takes the most recent annulus that was kept or interpolated
+        cols = np.arange(polar_img.shape[1])
+        source = np.maximum.accumulate(np.where(copy_cols, -1, cols))
+        from_last = copy_cols & (source < 0)
+        from_prev = copy_cols & (source >= 0)
+        polar_img[:, from_prev] = polar_img[:, source[from_prev]]
+        polar_img[:, from_last] = last_annulus[:, None]
+
+    return polar_img
+
+'''
+Vectorized version of the radial fill: every radial line (row of the polar image) is interpolated at once.
+Radial lines with no good data are left unchanged. The output is bit-identical to _fill_radial_lines_loop.
+'''
+def fill_radial_lines(polar_img, bad_data_value):
+    bad = polar_img == bad_data_value
+    n_bad = np.sum(bad, axis=1)
+    interp_rows = (n_bad > 0) & (n_bad < polar_img.shape[1])
+    periodic_interp_columns(polar_img.T, bad.T, interp_rows)
+    return polar_img
 
 # This function finds a profile and rotates it to create an idealized surface.
 # Gaps in the original DEM are rplaced with values from the rotated profile surface.
 def dem_interp_profile(dem_with_holes, center, rsize, tsize, bad_data_value = 32767, profile_type = 'mean', cratername='',
-                       outpath='',savefigs=True):
+                       outpath='',savefigs=True, polar_grid=None, sparse=False, dtype=float, in_place=False):
+    return dem_interp_profiles(dem_with_holes, center, rsize, tsize, bad_data_value=bad_data_value,
+                               profile_types=[profile_type], cratername=cratername, outpath=outpath, savefigs=savefigs,
+                               polar_grid=polar_grid, sparse=sparse, dtype=dtype, in_place=in_place)[profile_type]
+
+#Returns true if method is one of the profile methods: 'mean', 'median', 'min', 'max', or a quantile such as 'q25'
+def is_profile_method(method):
+    if method in ['mean', 'median', 'min', 'max']:
+        return True
+    try:
+        return method[0] == 'q' and 0 <= float(method[1:]) <= 100
+    except (TypeError, ValueError, IndexError):
+        return False
+
+'''
+Calculates several statistics of every column (radius) of a polar image at once. The good samples of each column are
+sorted once, and every statistic is read from the sorted samples, instead of running a separate reduction for each.
+
+polar_img = Polar image, with bad data marked by bad_data_value
+profile_types = List of statistics: 'mean', 'median', 'min', 'max', or 'qNN' for the NN-th percentile (e.g. 'q10',
+                'q2.5'). Quantiles are linearly interpolated between samples, as with np.nanquantile.
+dtype = Floating point type of the sorted copy of the polar image. np.float32 halves its memory.
+
+Returns a dict with the profile (one value per column) of each statistic. Columns with no good data are NaN.
+'''
+def profile_statistics(polar_img, bad_data_value, profile_types, dtype=float):
+    values = polar_img.astype(dtype)
+    values[polar_img == bad_data_value] = np.nan
+    #NaNs are sorted to the end, so the n good samples of a column are its first n rows
+    values.sort(axis=0)
+    n = np.sum(~np.isnan(values), axis=0)
+    cols = np.arange(values.shape[1])
+    empty = n == 0
+    last = np.maximum(n - 1, 0)
+
+    profiles = {}
+    for profile_type in profile_types:
+        if profile_type == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                profile = np.nansum(values, axis=0, dtype=np.float64)/n
+        elif profile_type == 'min':
+            profile = values[0].astype(np.float64)
+        elif profile_type == 'max':
+            profile = values[last, cols].astype(np.float64)
+        else:
+            q = 0.5 if profile_type == 'median' else float(profile_type[1:])/100
+            position = q*last
+            lower = np.floor(position).astype(np.intp)
+            upper = np.minimum(lower + 1, last)
+            low = values[lower, cols].astype(np.float64)
+            profile = low + (position - lower)*(values[upper, cols] - low)
+        profile[empty] = np.nan
+        profiles[profile_type] = profile
+    return profiles
+
+'''
+Fills the gaps in the DEM with the profiles of several statistics at once (see profile_statistics). The DEM is
+unwrapped and its columns sorted only once, however many profiles are requested.
+
+profile_types = List of statistics to use, e.g. ['mean', 'median', 'q10', 'q90']
+dtype = Floating point type used for the statistics (see profile_statistics)
+in_place = Set to true to fill the holes of dem_with_holes itself, instead of a copy. Only useful with one profile type,
+           or with iter_profile_fills, since every profile is written into the same array.
+
+Returns a dict with the filled DEM for each profile type.
+'''
+def dem_interp_profiles(dem_with_holes, center, rsize, tsize, bad_data_value = 32767, profile_types = ['mean'],
+                        cratername='', outpath='', savefigs=True, polar_grid=None, sparse=False, dtype=float,
+                        in_place=False):
+    return dict(iter_profile_fills(dem_with_holes, center, rsize, tsize, bad_data_value=bad_data_value,
+                                   profile_types=profile_types, cratername=cratername, outpath=outpath,
+                                   savefigs=savefigs, polar_grid=polar_grid, sparse=sparse, dtype=dtype,
+                                   in_place=in_place))
+
+#Generator version of dem_interp_profiles. Yields (profile_type, filled DEM) pairs one at a time, making each filled
+#DEM only when it is asked for, so that only one of them needs to be in memory at once. With in_place, each filled DEM
+#is dem_with_holes itself, and the holes are found before the first one is made, so they can be filled again for the
+#next profile whether or not the caller puts the bad data back in between.
+def iter_profile_fills(dem_with_holes, center, rsize, tsize, bad_data_value = 32767, profile_types = ['mean'],
+                       cratername='', outpath='', savefigs=True, polar_grid=None, sparse=False, dtype=float,
+                       in_place=False):
     if savefigs: save_dem_fig(dem_with_holes, cratername + '_with_holes.png', outpath, bad_data_value=bad_data_value)
     mask = dem_with_holes == bad_data_value
 
     print("'Unwrapping' the image into a rectangle where the axes are theta, radius")
-    polar_img = cv2.warpPolar(dem_with_holes,(rsize, tsize),(center[0], center[1]), maxRadius=rsize, flags=cv2.INTER_NEAREST)
+    polar_img = unwrap_polar(dem_with_holes, center, rsize, tsize, polar_grid)
     if savefigs: save_dem_fig(dem_with_holes, cratername + '_polar.png', outpath, bad_data_value=bad_data_value)
 
-    polar_img = polar_img.astype(float)
-    polar_img[polar_img == bad_data_value] = np.nan
-    if profile_type == 'median':
-        print('Calculating median profile')
-        profile = np.nanmedian(polar_img, axis=0)
-    if profile_type == 'mean':
-        print('Calculating mean profile')
-        profile = np.nanmean(polar_img, axis=0)
-    if profile_type == 'min':
-        print('Calculating min profile')
-        profile = np.nanmin(polar_img,axis = 0)
-    if profile_type == 'max':
-        print('Calculating max profile')
-        profile = np.nanmax(polar_img,axis=0)
-
-    print("Extending the profile to fill a rectangle the size of the image")
-    profile_img = np.array(np.tile(profile, (tsize,1)),dtype=int)
-
-    print("Re-wrap the profile image back to x,y coordinates")
-    profile_dem = cv2.warpPolar(profile_img,dem_with_holes.shape[::-1],(center[0],center[1]),maxRadius=rsize, flags=cv2.INTER_NEAREST+cv2.WARP_INVERSE_MAP)
-
-    print("Fill in the holes with values from the profile image")
-    dem_filled = copy.copy(dem_with_holes)
-    dem_filled[mask] = profile_dem[mask]
-
-    if savefigs: save_dem_fig(dem_filled, cratername + '_filled_'+profile_type+'.png', outpath, bad_data_value=bad_data_value)
-
-    return dem_filled
\ No newline at end of file
+    with instrument.stage('fill'):
+        print('Calculating '+', '.join(profile_types)+' profiles')
+        profiles = profile_statistics(polar_img, bad_data_value, profile_types, dtype=dtype)
+    del polar_img
+
+    #every angle of a re-wrapped profile image has the same row, so only the radius of each hole pixel's polar pixel
+    #is needed. This gives the same values as re-wrapping a whole (tsize, rsize) image of the profile.
+    with instrument.stage('inverse warp'):
+        if sparse:
+            points = np.where(mask)
+            t, r = polar_coords(points, center, rsize, tsize)
+        elif polar_grid is not None:
+            hole_valid = polar_grid.dem_valid[mask]
+            hole_radii = polar_grid.dem_index[mask] % rsize
+        else:
+            hole_valid, hole_radii = polar_radii(mask, center, rsize, tsize)
+
+    for profile_type in profile_types:
+        profile = profiles.pop(profile_type)
+        with instrument.stage('inverse warp'):
+            dem_filled = dem_with_holes if in_place else copy.copy(dem_with_holes)
+            if sparse:
+                print("Sampling the "+profile_type+" profile at the radius of each hole pixel")
+                good = ~np.isnan(profile)
+                dem_filled[points] = np.interp(r, np.flatnonzero(good), profile[good])
+            else:
+                print("Fill in the holes with values from the "+profile_type+" profile")
+                dem_filled[mask] = np.where(hole_valid, np.array(profile, dtype=int)[hole_radii], 0)
+
+        if savefigs: save_dem_fig(dem_filled, cratername + '_filled_'+profile_type+'.png', outpath, bad_data_value=bad_data_value)
+        yield profile_type, dem_filled
+        del dem_filled
+
+'''
+Fills the gaps in the DEM with the annular, radial or profile methods on an adaptive polar grid (see
+polar_grid.AdaptivePolarGrid), whose angular resolution grows with radius so that each sample covers about one pixel.
+Only the clipped pixels are sampled back from the filled grid; the rest of the DEM is unchanged.
+
+grid = AdaptivePolarGrid for the DEM and crater center
+method = 'annular', 'radial', or a profile type ('mean', 'median', 'min', 'max' or a quantile such as 'q25')
+
+The bands of the grid have different numbers of angular steps, so the methods are adapted as follows:
+annular = Each band is filled with fill_annuli. An annulus at the inner edge of a band with too little good data
+          takes the last annulus of the band inside it, resampled to the band's angular steps.
+radial = The bands are resampled (nearest angle) onto the angular steps of the outermost band, so that each radial
+         line runs the full radius, and filled with fill_radial_lines. Each band then takes back its own angles.
+profiles = The statistic at each radius is taken over the angular samples of its band.
+
+dtype, in_place = As for dem_interp_profiles
+'''
+def dem_interp_adaptive(dem_with_holes, grid, method = 'annular', bad_data_value = 32767, cratername = 'crater',
+                        outpath = '', savefigs = True, dtype = float, in_place = False):
+    if is_profile_method(method):
+        return next(iter_adaptive_profile_fills(dem_with_holes, grid, profile_types=[method],
+                                                bad_data_value=bad_data_value, cratername=cratername,
+                                                outpath=outpath, savefigs=savefigs, dtype=dtype,
+                                                in_place=in_place))[1]
+
+    if savefigs: save_dem_fig(dem_with_holes, cratername + '_with_holes.png', outpath, bad_data_value=bad_data_value)
+    mask = dem_with_holes == bad_data_value
+    bands = unwrap_adaptive(dem_with_holes, grid, bad_data_value)
+
+    with instrument.stage('fill'):
+        if method == 'annular':
+            print('Filling in annuli')
+            previous = None
+            for b in range(len(bands)):
+                if previous is not None:
+                    previous = previous[resample_angles(len(previous), grid.tsizes[b])]
+                bands[b] = fill_annuli(bands[b], bad_data_value, previous_annulus=previous)
+                previous = bands[b][:, -1]
+        elif method == 'radial':
+            print('Filling in radial lines')
+            tsize = grid.tsizes[-1]
+            fine = np.concatenate([band[resample_angles(len(band), tsize)] for band in bands], axis=1)
+            fine = fill_radial_lines(fine, bad_data_value)
+            for b in range(len(bands)):
+                cols = slice(grid.r_start[b], grid.r_stop[b])
+                bands[b] = fine[resample_angles(tsize, grid.tsizes[b]), cols]
+            del fine
+
+    print('Sampling the filled grid at the clipped pixels')
+    with instrument.stage('inverse warp'):
+        points = np.where(mask)
+        dem_filled = dem_with_holes if in_place else copy.copy(dem_with_holes)
+        dem_filled[points] = grid.sample(bands, points, bad_data_value)
+
+    if savefigs: save_dem_fig(dem_filled, cratername + '_filled_' + method + '_adaptive.png', outpath,
+                              bad_data_value=bad_data_value)
+
+    return dem_filled
+
+#Unwraps a DEM onto the bands of an AdaptivePolarGrid
+def unwrap_adaptive(dem_with_holes, grid, bad_data_value = 32767):
+    print("'Unwrapping' the image onto an adaptive polar grid of "+str(len(grid.tsizes))+' bands, '+
+          str(grid.size())+' samples')
+    with instrument.stage('polar warp'):
+        return grid.unwrap(dem_with_holes, bad_data_value)
+
+'''
+Fills the gaps in the DEM with the profiles of several statistics on an adaptive polar grid, like iter_profile_fills.
+The DEM is unwrapped once, and the samples of each band are sorted once for all of the statistics (see
+profile_statistics). The statistic at each radius is taken over the angular samples of its band.
+
+Yields (profile_type, filled DEM) pairs one at a time, in the order of profile_types.
+'''
+def iter_adaptive_profile_fills(dem_with_holes, grid, profile_types = ['mean'], bad_data_value = 32767,
+                                cratername = 'crater', outpath = '', savefigs = True, dtype = float, in_place = False):
+    if savefigs: save_dem_fig(dem_with_holes, cratername + '_with_holes.png', outpath, bad_data_value=bad_data_value)
+    bands = unwrap_adaptive(dem_with_holes, grid, bad_data_value)
+
+    with instrument.stage('fill'):
+        print('Calculating '+', '.join(profile_types)+' profiles')
+        band_profiles = []
+        while bands:
+            band_profiles.append(profile_statistics(bands.pop(0), bad_data_value, profile_types, dtype=dtype))
+        profiles = {profile_type: np.concatenate([band[profile_type] for band in band_profiles])
+                    for profile_type in profile_types}
+        del band_profiles
+
+    points = np.where(dem_with_holes == bad_data_value)
+    r = np.hypot(points[1] - grid.center[0], points[0] - grid.center[1])
+    for profile_type in profile_types:
+        print('Sampling the '+profile_type+' profile at the radius of each hole pixel')
+        with instrument.stage('inverse warp'):
+            profile = profiles.pop(profile_type)
+            good = ~np.isnan(profile)
+            dem_filled = dem_with_holes if in_place else copy.copy(dem_with_holes)
+            dem_filled[points] = np.interp(r, np.flatnonzero(good), profile[good])
+
+        if savefigs: save_dem_fig(dem_filled, cratername + '_filled_' + profile_type + '_adaptive.png', outpath,
+                                  bad_data_value=bad_data_value)
+        yield profile_type, dem_filled
+        del dem_filled
+
+#Returns, for each of n_to angular steps, the index of the nearest of n_from angular steps around the same circle
+def resample_angles(n_from, n_to):
+    return np.floor((np.arange(n_to) + 0.5)*n_from/n_to).astype(np.int64) % n_from
@@ -0,0 +1,82 @@
+import os.path
+import threading
+import traceback
+import concurrent.futures
+import dem_interp
+import instrument
+
+#Writers that may still have figures being saved, so that wait_for_figures can wait for them.
+_open_writers = []
+_open_writers_lock = threading.Lock()
+
+'''
+Saves DEM figures in background threads, so the calculations can carry on (and finish) while the PNGs are written.
+
+Each figure is only saved once per writer: later requests for a file name that has already been saved are skipped.
+The DEM is downsampled and copied when the figure is requested, so the caller is free to change its array afterwards.
+
+workers = Number of threads used to save figures.
+dpi = Resolution of the saved figures.
+preview_pixels = If given, DEMs are downsampled so neither side is longer than this before plotting. Plotting a
+                 downsampled DEM is much faster, and at the size the figures are viewed it looks the same.
+
+Use it with dem_interp.set_figure_writer so that dem_interp.save_dem_fig hands its figures to the writer.
+'''
+class FigureWriter:
+    def __init__(self, workers=2, dpi=1000, preview_pixels=None):
+        self.dpi = dpi
+        self.preview_pixels = preview_pixels
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.saved = set()
+        self.lock = threading.Lock()
+        with _open_writers_lock:
+            _open_writers.append(self)
+
+    #Queues a figure to be saved. Returns False if a figure with this name has already been saved by this writer.
+    def save(self, dem_to_save, name, outpath, bad_data_value=[32767], colorbar=True):
+        filename = os.path.abspath(outpath + name)
+        with self.lock:
+            if filename in self.saved:
+                return False
+            self.saved.add(filename)
+        dem_for_fig = dem_interp.preview_copy(dem_to_save, self.preview_pixels)
+        future = self.pool.submit(self._write, dem_for_fig, name, outpath, bad_data_value, colorbar,
+                                  instrument.get_context())
+        with self.lock:
+            self.futures.append(future)
+        return True
+
+    def _write(self, dem_for_fig, name, outpath, bad_data_value, colorbar, context):
+        #record the figure with the crater/method that asked for it
+        instrument.set_context(**context)
+        try:
+            with instrument.stage('figure'):
+                dem_interp.write_dem_fig(dem_for_fig, name, outpath, bad_data_value=bad_data_value,
+                                         colorbar=colorbar, dpi=self.dpi)
+        except Exception:
+            print('Could not save figure ' + outpath + name + ':\n' + traceback.format_exc())
+
+    #Waits for all of the queued figures to be saved.
+    def wait(self):
+        with self.lock:
+            futures = list(self.futures)
+        concurrent.futures.wait(futures)
+
+    #Stops accepting figures. Figures already queued are still saved; if wait is False this returns without waiting.
+    def close(self, wait=True):
+        self.pool.shutdown(wait=wait)
+        if wait:
+            with _open_writers_lock:
+                if self in _open_writers:
+                    _open_writers.remove(self)
+
+'''
+Waits for every figure writer to finish saving its figures. Call this before a worker process exits, or when the
+figures are needed, e.g. after do_calc_vol has returned with savefigs=True.
+'''
+def wait_for_figures():
+    with _open_writers_lock:
+        writers = list(_open_writers)
+    for writer in writers:
+        writer.close(wait=True)
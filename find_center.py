@@ -1,5 +1,6 @@
 import matplotlib.pyplot as plot
 import numpy as np
+import cv2
 
 #Function to get x and y coordinates from the first 10 clicks, then close the image.
 def onclick(event):
@@ -40,6 +41,14 @@ def circlefit(dem):
     # define coordinates as arrays
     x = np.array(x)
     y = np.array(y)
+    xc, yc, r = fit_circle(x, y)
+
+    return xc, yc
+
+'''
+Least squares fit of a circle to points x, y. Returns the x and y coordinates of the center and the radius.
+'''
+def fit_circle(x, y):
     # create arrays used in circle calculation
     a1 = np.array([x, y, np.ones(np.shape(x))])
     a2 = np.array([-(x ** 2 + y ** 2)])
@@ -48,5 +57,121 @@ def circlefit(dem):
     a = np.linalg.lstsq(a1.T, a2.T, rcond=None)[0]
     xc = -0.5 * a[0]
     yc = -0.5 * a[1]
+    r = np.sqrt(np.maximum(xc ** 2 + yc ** 2 - a[2], 0))
+
+    return xc, yc, r
+
+'''
+Fits a plane to the terrain around the crater, so that a regional slope can be removed before looking for the rim.
+The plane is fit by least squares to the valid pixels in a frame around the edge of the DEM, which should be outside
+the crater. Pixels far from the plane (e.g. where the crater reaches into the frame) are dropped and the plane is fit
+again, a few times.
+
+dem = DEM image
+valid = Mask of the pixels to use
+border = Width of the frame, as a fraction of each side of the DEM
+
+Returns the plane as an image the same shape as the DEM.
+'''
+def fit_plane(dem, valid, border=0.1, iterations=3):
+    rows, cols = np.indices(dem.shape)
+    frame = ((rows < border * dem.shape[0]) | (rows >= (1 - border) * dem.shape[0]) |
+             (cols < border * dem.shape[1]) | (cols >= (1 - border) * dem.shape[1]))
+    use = valid & frame
+    if np.sum(use) < 3:
+        use = valid
+    if np.sum(use) < 3:
+        return np.zeros(dem.shape, dtype=np.float32)
+    a = np.column_stack([cols[use], rows[use], np.ones(np.sum(use))]).astype(np.float64)
+    z = dem[use].astype(np.float64)
+    keep = np.ones(len(z), dtype=bool)
+    for i in range(iterations):
+        coef = np.linalg.lstsq(a[keep], z[keep], rcond=None)[0]
+        residual = np.abs(a @ coef - z)
+        keep = residual <= 3 * np.median(residual) + 1e-6
+        if np.sum(keep) < 3:
+            break
+    return (coef[0] * cols + coef[1] * rows + coef[2]).astype(np.float32)
+
+'''
+This script finds the crater center without user input, so that it can be used in unattended batch runs.
+
+The DEM is downsampled, and a plane fit to the terrain around the crater is subtracted, so that a regional slope does
+not make the far edge of the DEM the highest point (see fit_plane). The DEM is then 'unwrapped' into rays around a first
+guess of the center. The rim is taken to be the first point along each ray that comes within rim_tolerance of the
+highest point of the ray, so that noise or gentle rises beyond the rim are not mistaken for it. The existing least
+squares circle fit is used to fit a circle to the rim points. Rim points far from the circle (e.g. where a fan or a gap
+in the rim is) are dropped and the circle is fit again. This is repeated around the new center a few times.
+
+dem = DEM image
+bad_data = Bad data value, ignored when looking for the rim
+initial_center = First guess of the [x, y] center in pixels. Defaults to the middle of the deepest part of the DEM, once
+                 the plane of the surrounding terrain has been subtracted.
+max_size = The DEM is downsampled so that neither side is longer than this
+n_rays = Number of rays around the center on which to find the rim
+min_radius = Fraction of the largest radius within which rim points are ignored, e.g. to skip central peaks
+iterations = Number of times to refit around the new center
+rim_tolerance = Fraction of the relief along a ray (highest minus lowest point) within which a point counts as the
+                highest point
+
+Returns the x and y coordinates of the center, the radius of the rim in pixels, and a fit-quality score between 0
+and 1. The score is the fraction of rays whose rim point agrees with the circle, reduced in proportion to the rms
+distance of those points from the circle (reaching 0 when it is 10% of the radius). Low scores mean the center
+should be checked, e.g. with circlefit.
+'''
+def auto_center(dem, bad_data=32767, initial_center=None, max_size=1000, n_rays=360, min_radius=0.05, iterations=3,
+                rim_tolerance=0.02):
+    step = max(1, int(np.ceil(max(dem.shape) / max_size)))
+    small = np.array(dem[::step, ::step], dtype=np.float32)
+    valid = (small != bad_data) & np.isfinite(small)
+    small[~valid] = 0
+    small -= fit_plane(small, valid)
+    small[~valid] = 0
+    if initial_center is None:
+        #the middle of the deepest part of the DEM, below the plane of the surrounding terrain
+        deep = valid & (small < 0.5 * np.min(small[valid])) if np.any(valid) else valid
+        if np.any(deep):
+            rows, cols = np.nonzero(deep)
+            center = [np.mean(cols), np.mean(rows)]
+        else:
+            center = [(small.shape[1] - 1) / 2, (small.shape[0] - 1) / 2]
+    else:
+        center = [initial_center[0] / step, initial_center[1] / step]
+
+    rmax = int(np.ceil(np.hypot(small.shape[0], small.shape[1])))
+    angles = 2 * np.pi * np.arange(n_rays) / n_rays
+    xc, yc, r, score = center[0], center[1], 0.0, 0.0
+    for i in range(iterations):
+        # rays around the center, one pixel per radial step. Points off the DEM or on bad data can't be the rim
+        flags = cv2.INTER_LINEAR + cv2.WARP_FILL_OUTLIERS
+        rays = cv2.warpPolar(small, (rmax, n_rays), (float(xc), float(yc)), maxRadius=rmax, flags=flags)
+        rays_valid = cv2.warpPolar(valid.astype(np.float32), (rmax, n_rays), (float(xc), float(yc)),
+                                   maxRadius=rmax, flags=flags) > 0.999
+        rays[~rays_valid] = -np.inf
+        rays[:, :int(min_radius * rmax) + 1] = -np.inf
+
+        top = np.max(rays, axis=1)
+        bottom = np.min(np.where(np.isfinite(rays), rays, np.inf), axis=1)
+        with np.errstate(invalid='ignore'):
+            near_top = rays >= (top - rim_tolerance * (top - bottom))[:, None]
+        rim_r = np.argmax(near_top, axis=1)
+        found = np.isfinite(top) & np.isfinite(rays[np.arange(n_rays), rim_r])
+        if np.sum(found) < 3:
+            print('Could not find the crater rim!')
+            return center[0] * step, center[1] * step, 0.0, 0.0
+        rim_x = xc + rim_r * np.cos(angles)
+        rim_y = yc + rim_r * np.sin(angles)
+
+        # fit, drop rim points far from the circle, and fit again
+        x_fit, y_fit, r_fit = fit_circle(rim_x[found], rim_y[found])
+        residual = np.abs(np.hypot(rim_x - x_fit, rim_y - y_fit) - r_fit)
+        inliers = found & (residual <= 3 * np.median(residual[found]) + 1)
+        if np.sum(inliers) >= 3:
+            x_fit, y_fit, r_fit = fit_circle(rim_x[inliers], rim_y[inliers])
+        xc, yc, r = float(np.squeeze(x_fit)), float(np.squeeze(y_fit)), float(np.squeeze(r_fit))
+
+        residual = np.hypot(rim_x[inliers] - xc, rim_y[inliers] - yc) - r
+        rms = np.sqrt(np.mean(residual ** 2))
+        score = np.sum(inliers) / n_rays * max(0.0, 1 - rms / (0.1 * r)) if r > 0 else 0.0
 
-    return xc, yc
\ No newline at end of file
+    return xc * step, yc * step, r * step, float(score)
\ No newline at end of file
@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+'''
+Timing and memory instrumentation for the stages of the volume calculation.
+
+The pipeline wraps each stage (reading, building masks, polar warps, fills, writing, volumes, figures) in
+instrument.stage('name'). Nothing is recorded unless a RunReport has been started with start_report, so the stages
+cost nothing in normal runs. Each recorded stage has its wall time, the CPU time of the thread that ran it, and the
+peak resident memory (RSS) of the process while it ran, plus the crater/method it belongs to, set with set_context.
+
+The CPU time only counts the thread that opened the stage, so that stages running at the same time in different
+threads don't count each other's work. A stage that hands its work to other threads (e.g. the 'fill' of
+dem_interp.dem_interp_local) under-counts its CPU time, so the work done in each of those threads is recorded as a
+stage of its own (e.g. 'hole fill'). Work spread over threads inside OpenCV or numpy isn't counted.
+'''
+
+#Report that stages are recorded to. None when instrumentation is off.
+_report = None
+#Crater/method context of the current thread, added to every stage it records.
+_context = threading.local()
+
+#Returns the current resident memory of the process in bytes, or None if it can't be found on this system.
+def current_rss():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+'''
+Collects the stage records of a run, and samples the memory of the process in a background thread so that the
+peak RSS during each stage can be recorded.
+
+sample_interval = Seconds between memory samples.
+profile = Optional extra profiling: 'cprofile' runs cProfile for the whole run, and 'tracemalloc' records the peak
+          memory allocated by Python and numpy during each stage. tracemalloc has a single process-wide peak, so it is
+          folded into every open stage whenever a stage begins or ends, before being reset, so that a stage's peak
+          includes the peaks of the stages nested inside it.
+'''
+class RunReport:
+    def __init__(self, sample_interval=0.02, profile=None):
+        self.stages = []
+        self.lock = threading.Lock()
+        self.sample_interval = sample_interval
+        self.profile = profile
+        self.profiler = None
+        self.open_stages = []
+        self.memory = []
+        self.start_time = time.time()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        if profile == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profile == 'tracemalloc':
+            tracemalloc.start()
+        self._sampler.start()
+
+    #Updates the peak RSS of every stage that is running
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = current_rss()
+            if rss is None:
+                return
+            with self.lock:
+                for record in self.open_stages:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], rss/1e6)
+
+    def begin(self, name, context):
+        rss = current_rss()
+        record = dict(context)
+        record.update({'stage': name, 'start': time.time() - self.start_time,
+                       'rss_start_mb': None if rss is None else rss/1e6,
+                       'peak_rss_mb': 0.0 if rss is None else rss/1e6,
+                       '_wall': time.perf_counter(), '_cpu': time.thread_time()})
+        with self.lock:
+            if self.profile == 'tracemalloc':
+                self._fold_traced_peak()
+                record['_traced'] = record['_traced_peak'] = tracemalloc.get_traced_memory()[0]
+            self.open_stages.append(record)
+        return record
+
+    #Adds the tracemalloc peak since the last reset to the running peak of every open stage, then resets it.
+    #Must be called with the lock held.
+    def _fold_traced_peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for record in self.open_stages:
+            record['_traced_peak'] = max(record['_traced_peak'], peak)
+        tracemalloc.reset_peak()
+
+    def end(self, record):
+        record['wall_time'] = time.perf_counter() - record.pop('_wall')
+        record['cpu_time'] = time.thread_time() - record.pop('_cpu')
+        rss = current_rss()
+        with self.lock:
+            if self.profile == 'tracemalloc':
+                self._fold_traced_peak()
+                record['traced_peak_mb'] = (record.pop('_traced_peak') - record.pop('_traced'))/1e6
+            self.open_stages.remove(record)
+            if rss is not None:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], rss/1e6)
+                record['rss_end_mb'] = rss/1e6
+            self.stages.append(record)
+
+    #Stops sampling and profiling. If filename is given, the report is saved there as JSON, and cProfile statistics
+    #(if used) are saved next to it with the extension .prof
+    def finish(self, filename=None):
+        self._stop.set()
+        self._sampler.join()
+        if self.profiler is not None:
+            self.profiler.disable()
+        elif self.profile == 'tracemalloc':
+            tracemalloc.stop()
+        if filename is not None:
+            print('Saving run report '+filename)
+            with open(filename, 'w') as f:
+                json.dump({'stages': self.stages, 'summary': self.summary(), 'memory': self.memory,
+                           'notes': {'cpu_time': 'CPU time of the thread that ran each stage. Stages that hand '
+                                                 'work to other threads record that work as stages of their own.'}},
+                          f, indent=1)
+            if self.profiler is not None:
+                self.profiler.dump_stats(os.path.splitext(filename)[0] + '.prof')
+
+    #Totals the wall and CPU time, and the highest peak RSS, of each stage for each crater and method
+    def summary(self):
+        totals = {}
+        for record in self.stages:
+            key = (record.get('crater', ''), record.get('method', ''), record['stage'])
+            total = totals.setdefault(key, {'crater': key[0], 'method': key[1], 'stage': key[2], 'count': 0,
+                                            'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_mb': 0.0})
+            total['count'] += 1
+            total['wall_time'] += record['wall_time']
+            total['cpu_time'] += record['cpu_time']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+        return list(totals.values())
+
+#Starts recording stages to a new RunReport, and returns it
+def start_report(sample_interval=0.02, profile=None):
+    global _report
+    _report = RunReport(sample_interval=sample_interval, profile=profile)
+    return _report
+
+#Stops recording stages, and saves the report if filename is given. Returns the finished report.
+def finish_report(filename=None):
+    global _report
+    report = _report
+    _report = None
+    if report is not None:
+        report.finish(filename)
+    return report
+
+#Sets the crater/method (or any other labels) added to the stages recorded by the current thread
+def set_context(**context):
+    _context.values = context
+
+#Returns the labels set with set_context for the current thread
+def get_context():
+    return dict(getattr(_context, 'values', {}))
+
+#Adds a record of projected and actual memory (or any other values) to the report, if one has been started
+def record_memory(**values):
+    report = _report
+    if report is not None:
+        record = get_context()
+        record.update(values)
+        with report.lock:
+            report.memory.append(record)
+
+'''
+Tracks the peak resident memory (RSS) of the process in a background thread, whether or not a report is running.
+Use as a context manager, e.g.
+    with instrument.MemoryMonitor() as monitor:
+        ...
+    print(monitor.peak_mb)
+or call start() and stop().
+start_mb is the RSS when it started and peak_mb the highest RSS seen. Both are None if the RSS can't be found.
+'''
+class MemoryMonitor:
+    def __init__(self, sample_interval=0.02):
+        self.sample_interval = sample_interval
+        self.start_mb = None
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _update(self):
+        rss = current_rss()
+        if rss is None:
+            return False
+        self.peak_mb = max(self.peak_mb or 0.0, rss/1e6)
+        return True
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            if not self._update():
+                return
+
+    def start(self):
+        rss = current_rss()
+        if rss is not None:
+            self.start_mb = self.peak_mb = rss/1e6
+            self._sampler.start()
+        return self
+
+    def stop(self):
+        if self._sampler.is_alive():
+            self._stop.set()
+            self._sampler.join()
+            self._update()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+'''
+Context manager that records a stage of the pipeline, e.g.
+    with instrument.stage('polar warp'):
+        polar_img = ...
+Does nothing if no report has been started.
+'''
+@contextlib.contextmanager
+def stage(name):
+    report = _report
+    if report is None:
+        yield
+        return
+    record = report.begin(name, get_context())
+    try:
+        yield
+    finally:
+        report.end(record)
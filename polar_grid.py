@@ -0,0 +1,219 @@
+import functools
+import numpy as np
+import cv2
+import instrument
+
+'''
+Lookup tables for converting a DEM to polar coordinates (theta, radius) and back.
+
+cv2.warpPolar works out its coordinate maps every time it is called, so filling the same DEM with several methods
+repeats the same work for every method. This class runs cv2.warpPolar once in each direction on images of pixel
+indices, and keeps the resulting index tables. Unwrapping or re-wrapping an image is then a single array lookup,
+and gives the same pixels as cv2.warpPolar with INTER_NEAREST.
+
+Pixels with no source pixel (polar pixels outside the DEM, or DEM pixels outside maxRadius) are set to 0.
+
+shape = Shape (rows, columns) of the DEM
+center = Two-element list containing the x and y image coordinates of the center of the crater.
+rsize = Number of radial steps to use when converting the image to polar coordinates
+tsize = Number of angular steps to use when converting the image to polar coordinates
+inverse = Set to false to skip the tables for re-wrapping, which are the size of the DEM, when only unwrap is needed
+          (e.g. for fills that are sampled only at the clipped pixels).
+'''
+class PolarGrid:
+    def __init__(self, shape, center, rsize, tsize, inverse=True):
+        self.shape = tuple(shape)
+        self.center = (float(center[0]), float(center[1]))
+        self.rsize = int(rsize)
+        self.tsize = int(tsize)
+
+        print('Calculating polar coordinate lookup tables')
+        with instrument.stage('polar tables'):
+            #forward: which DEM pixel each polar pixel comes from. Indices are offset by 1 so that 0 marks "no pixel".
+            rows, cols = np.indices(self.shape, dtype=np.float32)
+            polar_rows = self._warp(rows + 1, (self.rsize, self.tsize), 0)
+            polar_cols = self._warp(cols + 1, (self.rsize, self.tsize), 0)
+            self.polar_valid = polar_rows > 0
+            self.polar_index = self._flat_index(polar_rows, polar_cols, self.shape)
+            del rows, cols, polar_rows, polar_cols
+
+            self.dem_valid = None
+            self.dem_index = None
+            if not inverse:
+                return
+
+            #inverse: which polar pixel each DEM pixel comes from.
+            thetas, radii = np.indices((self.tsize, self.rsize), dtype=np.float32)
+            dem_thetas = self._warp(thetas + 1, self.shape[::-1], cv2.WARP_INVERSE_MAP)
+            dem_radii = self._warp(radii + 1, self.shape[::-1], cv2.WARP_INVERSE_MAP)
+            self.dem_valid = dem_thetas > 0
+            self.dem_index = self._flat_index(dem_thetas, dem_radii, (self.tsize, self.rsize))
+
+    def _warp(self, img, dsize, flags):
+        return cv2.warpPolar(img, dsize, self.center, maxRadius=self.rsize,
+                             flags=cv2.INTER_NEAREST + cv2.WARP_FILL_OUTLIERS + flags)
+
+    #Combines 1-offset row and column tables into flat indices into a source image with the given shape,
+    #using a 32 bit integer type when it is big enough.
+    @staticmethod
+    def _flat_index(rows, cols, source_shape):
+        dtype = np.int32 if source_shape[0]*source_shape[1] < np.iinfo(np.int32).max else np.int64
+        index = (rows.astype(dtype) - 1) * source_shape[1] + (cols.astype(dtype) - 1)
+        index[rows == 0] = 0
+        return index
+
+    #'Unwraps' a DEM into a (tsize, rsize) image where the axes are theta, radius
+    def unwrap(self, dem):
+        polar_img = np.zeros((self.tsize, self.rsize), dtype=dem.dtype)
+        polar_img[self.polar_valid] = dem.ravel()[self.polar_index[self.polar_valid]]
+        return polar_img
+
+    #Re-wraps a (tsize, rsize) polar image back to x,y coordinates
+    def rewrap(self, polar_img):
+        dem = np.zeros(self.shape, dtype=polar_img.dtype)
+        dem[self.dem_valid] = polar_img.ravel()[self.dem_index[self.dem_valid]]
+        return dem
+
+
+#Cached version of the PolarGrid constructor. The least recently used grids are dropped when the cache is full.
+@functools.lru_cache(maxsize=4)
+def _cached_polar_grid(shape, center, rsize, tsize, inverse):
+    return PolarGrid(shape, center, rsize, tsize, inverse=inverse)
+
+'''
+Returns the PolarGrid for a DEM shape, crater center and polar size, reusing a previously calculated grid if the
+same one has been requested recently. Set inverse to false to get a grid without the re-wrapping tables.
+'''
+def get_polar_grid(shape, center, rsize, tsize, inverse=True):
+    return _cached_polar_grid(tuple(int(s) for s in shape), (float(center[0]), float(center[1])), int(rsize), int(tsize),
+                              bool(inverse))
+
+#Empties the caches of polar grids, e.g. to free memory between craters.
+def clear_polar_grid_cache():
+    _cached_polar_grid.cache_clear()
+    _cached_adaptive_polar_grid.cache_clear()
+
+
+'''
+A polar grid whose angular resolution grows with radius, so that every sample covers about one DEM pixel.
+
+The fixed grid used by cv2.warpPolar has the same number of angular steps at every radius, so it undersamples the
+angle near the rim of a large crater and oversamples it near the center. This grid is split into bands of radius.
+Each band has one radial step per pixel, and enough angular steps that neighbouring samples at the outer edge of the
+band are at most one pixel apart. Band widths grow by band_ratio, so no band oversamples the angle by more than that
+factor. The number of samples, and so the run time of the fills, is about pi * max_radius^2 * band_ratio.
+
+Each band is unwrapped into its own (tsize, nr) image, where tsize is the band's number of angular steps and nr its
+number of radial steps. Samples are taken from the nearest DEM pixel. Samples outside the DEM are marked as bad data.
+
+shape = Shape (rows, columns) of the DEM
+center = Two-element list containing the x and y image coordinates of the center of the crater.
+max_radius = Largest radius of the grid in pixels. Defaults to the distance from the center to the farthest corner
+             of the DEM.
+band_ratio = Ratio of the outer to the inner radius of each band.
+min_band_width = Width in pixels of the innermost bands.
+'''
+class AdaptivePolarGrid:
+    def __init__(self, shape, center, max_radius=None, band_ratio=1.25, min_band_width=8):
+        self.shape = tuple(shape)
+        self.center = (float(center[0]), float(center[1]))
+        if max_radius is None:
+            max_radius = bounds_radius(self.shape, self.center)
+        self.max_radius = int(np.ceil(max_radius))
+
+        print('Calculating adaptive polar grid')
+        with instrument.stage('polar tables'):
+            #radial edges of the bands
+            edges = [0]
+            while edges[-1] < self.max_radius:
+                width = max(min_band_width, int(np.ceil(edges[-1]*(band_ratio - 1))))
+                edges.append(min(edges[-1] + width, self.max_radius))
+            self.r_start = np.array(edges[:-1])
+            self.r_stop = np.array(edges[1:])
+            #enough angular steps for the samples at the outer edge of each band to be one pixel apart
+            self.tsizes = np.maximum(8, 4*np.ceil(2*np.pi*self.r_stop/4)).astype(int)
+
+            index_dtype = np.int32 if self.shape[0]*self.shape[1] < np.iinfo(np.int32).max else np.int64
+            self.index = []
+            self.valid = []
+            for r_start, r_stop, tsize in zip(self.r_start, self.r_stop, self.tsizes):
+                angle = 2*np.pi*np.arange(tsize)[:, None]/tsize
+                r = np.arange(r_start, r_stop)[None, :]
+                x = np.rint(self.center[0] + r*np.cos(angle)).astype(np.int64)
+                y = np.rint(self.center[1] + r*np.sin(angle)).astype(np.int64)
+                valid = (x >= 0) & (x < self.shape[1]) & (y >= 0) & (y < self.shape[0])
+                self.index.append(np.where(valid, y*self.shape[1] + x, 0).astype(index_dtype))
+                self.valid.append(valid)
+
+    #Total number of samples in the grid
+    def size(self):
+        return int(np.sum(self.tsizes*(self.r_stop - self.r_start)))
+
+    #Returns the band number of each radius
+    def band_of(self, r):
+        return np.clip(np.searchsorted(self.r_stop, r, side='right'), 0, len(self.r_stop) - 1)
+
+    #'Unwraps' a DEM into a list of (tsize, nr) images, one per band. Samples outside the DEM are set to bad_data_value.
+    def unwrap(self, dem, bad_data_value=32767):
+        flat = dem.ravel()
+        bands = []
+        for index, valid in zip(self.index, self.valid):
+            band = flat[index]
+            band[~valid] = bad_data_value
+            bands.append(band)
+        return bands
+
+    '''
+    Samples band images made with unwrap (and then filled) at the given DEM pixels, with bilinear interpolation in
+    radius and angle (wrapping around in angle). Samples holding bad data are left out of the interpolation; pixels
+    with no usable neighbours are returned as bad_data_value.
+
+    points = (rows, columns) of the DEM pixels to sample, e.g. from np.where(mask)
+    '''
+    def sample(self, bands, points, bad_data_value=32767):
+        dx = points[1] - self.center[0]
+        dy = points[0] - self.center[1]
+        r = np.minimum(np.hypot(dx, dy), self.max_radius - 1)
+        fraction = np.mod(np.arctan2(dy, dx), 2*np.pi)/(2*np.pi)
+        r0 = np.floor(r).astype(np.int64)
+        r1 = np.minimum(r0 + 1, self.max_radius - 1)
+        wr = r - r0
+
+        total = np.zeros(r.shape)
+        weights = np.zeros(r.shape)
+        for rr, w_r in [(r0, 1 - wr), (r1, wr)]:
+            band_numbers = self.band_of(rr)
+            for b in np.unique(band_numbers):
+                here = band_numbers == b
+                tsize = self.tsizes[b]
+                t = fraction[here]*tsize
+                t0 = np.floor(t).astype(np.int64)
+                wt = t - t0
+                col = rr[here] - self.r_start[b]
+                for tt, w_t in [(t0 % tsize, 1 - wt), ((t0 + 1) % tsize, wt)]:
+                    values = bands[b][tt, col].astype(np.float64)
+                    w = np.where(values != bad_data_value, w_r[here]*w_t, 0)
+                    total[here] += w*np.where(w > 0, values, 0)
+                    weights[here] += w
+        return np.where(weights > 0, total/np.where(weights > 0, weights, 1), bad_data_value)
+
+
+#Returns the distance from the center to the farthest corner of a DEM with the given shape
+def bounds_radius(shape, center):
+    corners_x = np.array([0, shape[1] - 1, 0, shape[1] - 1])
+    corners_y = np.array([0, 0, shape[0] - 1, shape[0] - 1])
+    return float(np.max(np.hypot(corners_x - center[0], corners_y - center[1]))) + 1
+
+#Cached version of the AdaptivePolarGrid constructor. The least recently used grids are dropped when the cache is full.
+@functools.lru_cache(maxsize=4)
+def _cached_adaptive_polar_grid(shape, center, max_radius):
+    return AdaptivePolarGrid(shape, center, max_radius=max_radius)
+
+'''
+Returns the AdaptivePolarGrid for a DEM shape, crater center and maximum radius, reusing a previously calculated grid
+if the same one has been requested recently.
+'''
+def get_adaptive_polar_grid(shape, center, max_radius=None):
+    if max_radius is not None:
+        max_radius = int(np.ceil(max_radius))
+    return _cached_adaptive_polar_grid(tuple(int(s) for s in shape), (float(center[0]), float(center[1])), max_radius)
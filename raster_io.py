@@ -0,0 +1,198 @@
+import numpy as np
+
+'''
+Functions for reading and writing DEMs with GDAL without loading the whole raster into memory.
+
+Windows are given as (xoff, yoff, xsize, ysize) in pixels of the full raster, the same order GDAL uses.
+'''
+
+'''
+Returns the metadata of a raster without reading any pixels.
+
+filename = Path to the raster
+band = Band number to describe. Defaults to the first band.
+
+Returns a dict with:
+shape = (rows, columns) of the raster
+geotransform = GDAL geotransform of the raster
+projection = Projection of the raster, as WKT
+dtype = numpy dtype of the band
+nodata = Nodata value of the band, or None if it has none
+block_size = (columns, rows) of the band's native blocks
+'''
+def raster_info(filename, band=1):
+    from osgeo import gdal, gdal_array
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise IOError('Could not open raster: ' + filename)
+    rb = ds.GetRasterBand(band)
+    info = {'shape': (ds.RasterYSize, ds.RasterXSize),
+            'geotransform': ds.GetGeoTransform(),
+            'projection': ds.GetProjection(),
+            'dtype': np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(rb.DataType)),
+            'nodata': rb.GetNoDataValue(),
+            'block_size': tuple(rb.GetBlockSize())}
+    ds = None
+    return info
+
+'''
+Returns the window (xoff, yoff, xsize, ysize) of a square of half-width radius around a center point, clipped to the
+edges of a raster with the given shape.
+
+center = Two-element list containing the x and y image coordinates of the center
+radius = Half-width of the window in pixels
+shape = (rows, columns) of the full raster
+'''
+def crater_window(center, radius, shape):
+    x0 = max(int(np.floor(center[0] - radius)), 0)
+    y0 = max(int(np.floor(center[1] - radius)), 0)
+    x1 = min(int(np.ceil(center[0] + radius)) + 1, shape[1])
+    y1 = min(int(np.ceil(center[1] + radius)) + 1, shape[0])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+#Returns the geotransform of a window within a raster with the given geotransform
+def window_geotransform(geotransform, window):
+    xoff, yoff = window[0], window[1]
+    gt = list(geotransform)
+    gt[0] = geotransform[0] + xoff*geotransform[1] + yoff*geotransform[2]
+    gt[3] = geotransform[3] + xoff*geotransform[4] + yoff*geotransform[5]
+    return tuple(gt)
+
+'''
+Reads a raster, or just a window of it.
+
+filename = Path to the raster
+window = (xoff, yoff, xsize, ysize) of the part of the raster to read. If None, the whole raster is read.
+band = Band number to read. Defaults to the first band.
+'''
+def read_raster(filename, window=None, band=1):
+    from osgeo import gdal
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise IOError('Could not open raster: ' + filename)
+    rb = ds.GetRasterBand(band)
+    if window is None:
+        arr = rb.ReadAsArray()
+    else:
+        arr = rb.ReadAsArray(int(window[0]), int(window[1]), int(window[2]), int(window[3]))
+    ds = None
+    return arr
+
+'''
+Reads a raster (or a window of it) block by block. Yields (block_window, block) pairs, where block_window is the
+(xoff, yoff, xsize, ysize) of the block in the full raster. Blocks are strips of full rows, block_rows tall. If
+block_rows is None, the height of the raster's native blocks is used.
+'''
+def iter_blocks(filename, window=None, block_rows=None, band=1):
+    from osgeo import gdal
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise IOError('Could not open raster: ' + filename)
+    rb = ds.GetRasterBand(band)
+    if window is None:
+        window = (0, 0, ds.RasterXSize, ds.RasterYSize)
+    if block_rows is None:
+        block_rows = rb.GetBlockSize()[1]
+    xoff, yoff, xsize, ysize = [int(w) for w in window]
+    for row in range(yoff, yoff + ysize, block_rows):
+        nrows = min(block_rows, yoff + ysize - row)
+        yield (xoff, row, xsize, nrows), rb.ReadAsArray(xoff, row, xsize, nrows)
+    ds = None
+
+'''
+Writes an array to a tiled, compressed GeoTIFF, borrowing the georeferencing, data type and nodata value of a
+template raster. The array is written in strips, so GDAL never needs a second full-size copy of it.
+
+filename = Path of the GeoTIFF to create
+arr = 2D array to write
+template_file = Raster to take the projection, geotransform, data type and nodata value from
+window = (xoff, yoff, xsize, ysize) of arr within the template raster, if arr is only a window of it
+nodata = Nodata value to write. Defaults to the template's nodata value.
+dtype = numpy dtype to write. Defaults to the template's data type.
+compress = GDAL compression to use.
+block_rows = Number of rows written at a time.
+'''
+def write_raster(filename, arr, template_file, window=None, nodata=None, dtype=None, compress='DEFLATE',
+                 block_rows=512):
+    from osgeo import gdal, gdal_array
+    info = raster_info(template_file)
+    if dtype is None:
+        dtype = info['dtype']
+    if nodata is None:
+        nodata = info['nodata']
+    geotransform = info['geotransform']
+    if window is not None:
+        geotransform = window_geotransform(geotransform, window)
+    [rows, cols] = arr.shape
+
+    options = ['TILED=YES', 'COMPRESS=' + compress, 'BIGTIFF=IF_SAFER']
+    if compress in ['DEFLATE', 'LZW', 'ZSTD']:
+        options.append('PREDICTOR=' + ('3' if np.issubdtype(dtype, np.floating) else '2'))
+    driver = gdal.GetDriverByName("GTiff")
+    outdata = driver.Create(filename, cols, rows, 1, gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype)), options)
+    outdata.SetGeoTransform(geotransform)
+    outdata.SetProjection(info['projection'])
+    outband = outdata.GetRasterBand(1)
+    if nodata is not None:
+        outband.SetNoDataValue(nodata)
+    for row in range(0, rows, block_rows):
+        outband.WriteArray(np.asarray(arr[row:row + block_rows], dtype=dtype), 0, row)
+    outdata.FlushCache()
+    outdata = None
+
+'''
+Rasterizes the polygons of a vector file (e.g. GeoJSON, Shapefile or GeoPackage) onto the grid of a raster, in memory.
+Polygons are reprojected to the raster's projection if they are in a different one.
+
+vector_file = Path to the vector file with the polygons
+template_file = Raster whose grid (geotransform, size and projection) the polygons are burned onto
+name_field = Attribute holding the name of each polygon. Polygons with the same name get the same label.
+window = (xoff, yoff, xsize, ysize) of the part of the raster to rasterize onto. If None, the whole raster is used.
+layer = Name or number of the layer to read. Defaults to the first layer.
+
+Returns the label raster, where pixels in the n-th name are labeled n (starting from 1) and pixels outside all polygons
+are 0, the list of names in label order, and a list of dicts with the attributes of each name's first polygon. Where
+polygons overlap, the later polygon in the file gets the pixels.
+'''
+def rasterize_polygons(vector_file, template_file, name_field='name', window=None, layer=0):
+    from osgeo import gdal, ogr
+    info = raster_info(template_file)
+    if window is None:
+        window = (0, 0, info['shape'][1], info['shape'][0])
+    geotransform = window_geotransform(info['geotransform'], window)
+
+    source = ogr.Open(vector_file)
+    if source is None:
+        raise IOError('Could not open vector file: ' + vector_file)
+    source_layer = source.GetLayer(layer)
+    if source_layer.GetLayerDefn().GetFieldIndex(name_field) < 0:
+        raise ValueError('Vector file ' + vector_file + ' has no ' + name_field + ' attribute')
+
+    #copy the polygons to a memory layer with a label attribute to burn, numbering the names in file order
+    memory = ogr.GetDriverByName('Memory').CreateDataSource('')
+    label_layer = memory.CreateLayer('labels', srs=source_layer.GetSpatialRef(), geom_type=ogr.wkbMultiPolygon)
+    label_layer.CreateField(ogr.FieldDefn('label', ogr.OFTInteger))
+    names = []
+    attributes = []
+    for feature in source_layer:
+        name = str(feature.GetField(name_field))
+        if name not in names:
+            names.append(name)
+            attributes.append(feature.items())
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        label_feature = ogr.Feature(label_layer.GetLayerDefn())
+        label_feature.SetGeometry(geometry.Clone())
+        label_feature.SetField('label', names.index(name) + 1)
+        label_layer.CreateFeature(label_feature)
+
+    target = gdal.GetDriverByName('MEM').Create('', int(window[2]), int(window[3]), 1, gdal.GDT_UInt16)
+    target.SetGeoTransform(geotransform)
+    target.SetProjection(info['projection'])
+    gdal.RasterizeLayer(target, [1], label_layer, options=['ATTRIBUTE=label'])
+    labels = target.GetRasterBand(1).ReadAsArray()
+    target = None
+    memory = None
+    source = None
+    return labels, names, attributes
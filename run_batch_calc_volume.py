@@ -0,0 +1,29 @@
+import batch_calc_volume
+
+# The batch runner processes many craters at once. The craters are listed in a manifest file, either a CSV file with
+# one row per crater or a YAML file with one entry per crater. For example, a CSV manifest looks like:
+#
+# crater,dem_file,dem_clipped_file,feature_files,fan_catchment_match,center_x,center_y,methods,pixel_size
+# Example_Crater,DEM.tif,DEM_clip_all.tif,Fan_1=DEM_clip_fan1.tif;Catchment_1=DEM_clip_catchment1.tif,Fan_1=Catchment_1,1590,1291,annular;radial,20.0
+#
+# Instead of the clipped DEMs, feature_files can be a single GeoJSON/Shapefile of the fan and catchment polygons, with
+# dem_clipped_file and fan_catchment_match left empty (see run_calc_volume.py):
+# Example_Crater,DEM.tif,,features.geojson,,1590,1291,annular;radial,20.0
+#
+# Multiple features, fan/catchment pairs, and methods are separated by semicolons. Leave center_x and center_y empty
+# to have the center found automatically from the crater rim.
+# See read_manifest in batch_calc_volume.py for the full list of fields.
+manifest_file = r"craters.csv"
+
+# The results for every crater are added to this file as soon as each crater is finished.
+# If the run is interrupted, run this script again and craters that are already in the results file will be skipped.
+# Craters that fail are listed, with the error, in a file ending in _failed.csv next to the results file.
+results_file = r"all_craters_cal_volume_results.csv"
+
+outpath = r"E:\Work\Sinuous Ridges\DTMs\\" # Specify the directory where results will be saved
+
+workers = 4 # Number of craters to run at the same time. Set to None to use one per CPU.
+
+# The guard below is needed so that the worker processes can start on Windows.
+if __name__ == '__main__':
+    batch_calc_volume.run_batch(manifest_file, results_file, workers=workers, outpath=outpath, savefigs=False)
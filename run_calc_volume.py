@@ -30,6 +30,14 @@ dem_feature_files = {'Fan_1':"DEM_clip_fan1.tif",
 fan_catchment_match = {'Fan_1':'Catchment_1',
                        'Fan_2':'Catchment_2'}
 
+# Instead of exporting the clipped DEMs, you can give a single GeoJSON, Shapefile or GeoPackage of the fan and
+# catchment polygons. Each polygon needs a 'name' attribute (e.g. Fan_1) and, for fans, a 'match' attribute with the
+# name of the matching catchment. The polygons are rasterized on the DEM grid, so only dem_file is read. To use it,
+# uncomment these lines:
+#dem_feature_files = r"features.geojson"
+#dem_clipped_file = None
+#fan_catchment_match = None
+
 # The interpolation method(s) are specified in a list (square brackets). Annular is recommended!
 # Linear and cubic are VERY slow and generally don't give great results.
 methods = ['annular']#, 'radial', 'min','max','mean','median','linear','cubic']
@@ -38,12 +46,22 @@ outpath = r"E:\Work\Sinuous Ridges\DTMs\\" # Specify the directory where results
 cratername = 'Example_Crater' # Specify the name of the crater, to be used in naming result files
 
 # The coordinates of the center of the crater, in pixels in the DEM. If you don't know, you can set this to None.
-# If this is None, the program will pop up an image of the crater and ask you to click 10 locations on the crater rim.
-# These will be used to fit a circle and determine the crater center.
+# If this is None, the center is found using center_method:
+# 'auto' = The crater rim is found in the DEM and fit with a circle. The fit score (0 to 1) is saved with the results.
+#          If the score is below 0.5 the run stops with an error; give the center or use 'click' instead.
+# 'click' = The program will pop up an image of the crater and ask you to click 10 locations on the crater rim.
+#           These will be used to fit a circle and determine the crater center.
 #crater_center = [1590, 1291]
 crater_center = None
+center_method = 'auto'
 
 pixel_size = 20.0 #DEM pixel size in meters. Pixels are assumed to be square.
 
+workers = None # Number of methods to run at the same time, in threads. Set to None to run them one after another.
+low_memory = False # Set to True for very large DEMs, to use less memory (see do_calc_vol in calc_volume.py).
+memory_budget_mb = None # Memory budget in MB. Fewer methods are run at the same time if they would need more.
+
 calc_volume.do_calc_vol(dem_file,dem_clipped_file, dem_feature_files, fan_catchment_match, methods, crater_center=crater_center,
-                bad_data = 32767, pixel_size=pixel_size, outpath = outpath,cratername=cratername, savefigs=True)
\ No newline at end of file
+                bad_data = 32767, pixel_size=pixel_size, outpath = outpath,cratername=cratername, savefigs=True,
+                center_method=center_method, workers=workers, low_memory=low_memory,
+                memory_budget_mb=memory_budget_mb)
\ No newline at end of file
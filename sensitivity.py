@@ -0,0 +1,177 @@
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import calc_volume
+import raster_io
+from polar_grid import PolarGrid
+
+'''
+Monte Carlo sensitivity of the volumes to the crater center and the polar resolution.
+
+The fills depend on the crater center (from find_center.circlefit or given by hand), on the number of radial steps
+derived from it, and on the number of angular steps. This module draws many perturbed centers and resolutions and
+calculates the fills and volumes for each of them in a pool of worker processes. The DEM, clipped DEM and feature
+labels are placed in shared memory once, and every worker reads them from there instead of getting its own copy.
+'''
+
+#Arrays attached from shared memory in a worker process, by name. The SharedMemory objects are kept with them so the
+#memory stays mapped for as long as the worker runs.
+_shared = {}
+
+#Copies an array into a new block of shared memory. Returns the SharedMemory and a description used to attach to it.
+def share_array(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+#Attaches to an array in shared memory, from the description returned by share_array. The array is read-only.
+def attach_array(description):
+    name, shape, dtype = description
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    arr.flags.writeable = False
+    return shm, arr
+
+#Worker process initializer: attaches the shared input arrays once per worker
+def _attach_inputs(descriptions):
+    for key in descriptions:
+        _shared[key] = attach_array(descriptions[key])
+
+#Runs the fills and volumes for one sample in a worker process
+def _run_sample(sample, methods, label_names, fan_catchment_match, pixel_size, bad_data, vectorized):
+    dem = _shared['dem'][1]
+    dem_clipped = _shared['dem_clipped'][1]
+    labels = _shared['labels'][1]
+    center = [sample['center_x'], sample['center_y']]
+    #each sample has its own center, so a polar grid is only worth making if several methods share it. It is made
+    #here rather than taken from the polar_grid cache, which would keep grids that no other sample can reuse.
+    polar_grid = False
+    if len(methods) > 1:
+        polar_grid = PolarGrid(dem_clipped.shape, center, sample['rsize'], sample['tsize'])
+    rows = []
+    for method in methods:
+        dem_filled = calc_volume.fill_dem(dem_clipped, center, sample['rsize'], sample['tsize'], bad_data=bad_data,
+                                          method=method, savefigs=False, vectorized=vectorized, polar_grid=polar_grid)
+        volumes = calc_volume.find_volumes(dem, dem_filled, labels, label_names, fan_catchment_match,
+                                           pixel_size=pixel_size)
+        row = dict(sample)
+        row['method'] = method
+        row.update(volumes)
+        rows.append(row)
+    return rows
+
+'''
+Draws perturbed centers and polar resolutions.
+
+crater_center = Nominal [x, y] of the crater center in pixels
+n_samples = Number of samples to draw
+center_sigma = Standard deviation in pixels of the normal perturbation of each center coordinate
+rsize_sigma = Standard deviation of the normal perturbation of the number of radial steps, as a fraction of the
+              number derived from the center (as in do_calc_vol)
+tsize_range = [min, max] of the number of angular steps, drawn uniformly
+seed = Random seed
+
+Returns a DataFrame with one row per sample. The first sample is the unperturbed nominal case.
+'''
+def draw_samples(crater_center, n_samples=100, center_sigma=5.0, rsize_sigma=0.05, tsize_range=(500, 2000), seed=0):
+    rng = np.random.default_rng(seed)
+    center_x = crater_center[0] + rng.normal(0, center_sigma, n_samples)
+    center_y = crater_center[1] + rng.normal(0, center_sigma, n_samples)
+    rsize = np.sqrt(center_x ** 2 + center_y ** 2) * (1 + rng.normal(0, rsize_sigma, n_samples))
+    tsize = rng.integers(tsize_range[0], tsize_range[1] + 1, n_samples)
+    center_x[0], center_y[0] = crater_center[0], crater_center[1]
+    rsize[0] = np.sqrt(crater_center[0] ** 2 + crater_center[1] ** 2)
+    tsize[0] = 1000
+    return pd.DataFrame({'sample': np.arange(n_samples), 'center_x': center_x, 'center_y': center_y,
+                         'rsize': np.maximum(rsize, 1).astype(int), 'tsize': tsize})
+
+'''
+Summarizes the distribution of the volume of each feature, for each method.
+
+samples = DataFrame of sample volumes from run_ensemble
+ci = Width of the confidence interval, e.g. 0.95 for the 2.5th to 97.5th percentiles.
+'''
+def summarize(samples, label_names, ci=0.95):
+    rows = []
+    for method, group in samples.groupby('method', sort=False):
+        for key in label_names:
+            if key not in group:
+                continue
+            volumes = group[key].to_numpy(dtype=float)
+            nominal = group.loc[group['sample'] == 0, key]
+            rows.append({'method': method, 'feature': key,
+                         'nominal': float(nominal.iloc[0]) if len(nominal) else np.nan,
+                         'mean': np.nanmean(volumes), 'std': np.nanstd(volumes), 'median': np.nanmedian(volumes),
+                         'ci_low': np.nanpercentile(volumes, 100*(1 - ci)/2),
+                         'ci_high': np.nanpercentile(volumes, 100*(1 + ci)/2), 'n': int(np.sum(~np.isnan(volumes)))})
+    return pd.DataFrame(rows)
+
+'''
+Runs the Monte Carlo ensemble on DEMs that are already in memory.
+
+dem, dem_clipped = Original and clipped DEMs
+labels, label_names = Feature label raster and names, from calc_volume.get_labels
+fan_catchment_match = Dict with keys for each fan and values for each corresponding catchment.
+crater_center = Nominal [x, y] of the crater center in pixels
+methods = List of fill methods to run for every sample
+n_samples, center_sigma, rsize_sigma, tsize_range, seed = See draw_samples
+workers = Number of worker processes. Defaults to the number of CPUs.
+ci = Width of the confidence intervals
+
+Returns a DataFrame with the volumes of every sample, and a DataFrame summarizing each feature's distribution.
+'''
+def run_ensemble(dem, dem_clipped, labels, label_names, fan_catchment_match, crater_center, methods=['annular'],
+                 n_samples=100, center_sigma=5.0, rsize_sigma=0.05, tsize_range=(500, 2000), seed=0, workers=None,
+                 pixel_size=20.0, bad_data=32767, vectorized=True, ci=0.95):
+    samples = draw_samples(crater_center, n_samples=n_samples, center_sigma=center_sigma, rsize_sigma=rsize_sigma,
+                           tsize_range=tsize_range, seed=seed)
+    print('Running '+str(n_samples)+' Monte Carlo samples with methods: '+str(methods))
+
+    blocks = {}
+    try:
+        descriptions = {}
+        for key, arr in [('dem', dem), ('dem_clipped', dem_clipped), ('labels', labels)]:
+            blocks[key], descriptions[key] = share_array(np.ascontiguousarray(arr))
+
+        rows = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_attach_inputs,
+                                                    initargs=(descriptions,)) as pool:
+            futures = [pool.submit(_run_sample, sample, methods, label_names, fan_catchment_match, pixel_size,
+                                   bad_data, vectorized) for sample in samples.to_dict('records')]
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                rows.extend(future.result())
+                print('Finished sample '+str(i + 1)+' of '+str(n_samples))
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+
+    results = pd.DataFrame(rows).sort_values(['sample', 'method'], kind='stable').reset_index(drop=True)
+    return results, summarize(results, label_names, ci=ci)
+
+'''
+Runs the Monte Carlo ensemble for a crater from its DEM files, reading each file once, and saves the sample volumes
+and summary to _sensitivity_samples.csv and _sensitivity_summary.csv files.
+
+The file inputs are the same as for calc_volume.do_calc_vol, except that crater_center is required. The remaining
+options are passed on to run_ensemble.
+'''
+def do_sensitivity(dem_file, dem_clipped_file, dem_feature_files, fan_catchment_match, crater_center,
+                   methods=['annular'], n_samples=100, center_sigma=5.0, rsize_sigma=0.05, tsize_range=(500, 2000),
+                   seed=0, workers=None, bad_data=32767, pixel_size=20.0, outpath='', cratername='crater',
+                   vectorized=True, ci=0.95):
+    dem = raster_io.read_raster(dem_file)
+    dem_clipped = raster_io.read_raster(dem_clipped_file)
+    labels, label_names = calc_volume.get_labels(dem_feature_files, bad_data=bad_data)
+
+    samples, summary = run_ensemble(dem, dem_clipped, labels, label_names, fan_catchment_match, crater_center,
+                                    methods=methods, n_samples=n_samples, center_sigma=center_sigma,
+                                    rsize_sigma=rsize_sigma, tsize_range=tsize_range, seed=seed, workers=workers,
+                                    pixel_size=pixel_size, bad_data=bad_data, vectorized=vectorized, ci=ci)
+    samples.insert(0, 'crater', cratername)
+    summary.insert(0, 'crater', cratername)
+    samples.to_csv(outpath+cratername+'_sensitivity_samples.csv', index=False)
+    summary.to_csv(outpath+cratername+'_sensitivity_summary.csv', index=False)
+    return samples, summary
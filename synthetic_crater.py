@@ -0,0 +1,112 @@
+import numpy as np
+
+'''
+Makes synthetic crater DEMs with fans and catchments of known volume, for testing and benchmarking.
+
+The crater is a parabolic bowl. Each fan is an elliptic paraboloid lobe added to the bowl near the foot of the crater
+wall, and each catchment is an elliptic paraboloid carved into the wall above its fan. Because the features are
+added to (or carved from) a known surface, their volumes are known exactly: both the sum of the added heights over the
+pixels of the feature, and the continuous volume of the paraboloid, pi*a*b*h/2.
+'''
+
+'''
+Adds an elliptic paraboloid of height h (negative to carve), with semi-axes a and b in pixels along and across the
+direction angle, centered at (x0, y0), to the dem. Only the bounding box of the feature is touched.
+
+Returns the mask of the feature and the sum of the heights added inside it.
+'''
+def add_paraboloid(dem, x0, y0, a, b, h, angle):
+    r = int(np.ceil(max(a, b))) + 1
+    rows = slice(max(int(y0) - r, 0), min(int(y0) + r + 1, dem.shape[0]))
+    cols = slice(max(int(x0) - r, 0), min(int(x0) + r + 1, dem.shape[1]))
+    yy, xx = np.mgrid[rows, cols]
+    u = (xx - x0)*np.cos(angle) + (yy - y0)*np.sin(angle)
+    v = -(xx - x0)*np.sin(angle) + (yy - y0)*np.cos(angle)
+    shape = 1 - (u/a)**2 - (v/b)**2
+    inside = shape > 0
+    heights = np.where(inside, h*shape, 0)
+    dem[rows, cols] += heights.astype(dem.dtype)
+
+    mask = np.zeros(dem.shape, dtype=bool)
+    mask[rows, cols] = inside
+    return mask, np.sum(heights[inside].astype(dem.dtype), dtype=np.float64)
+
+'''
+Makes a synthetic crater.
+
+size = Number of pixels along each side of the DEM
+n_pairs = Number of fan/catchment pairs
+pixel_size = Size of the pixels in meters
+bad_data = Value used for the clipped pixels
+seed = Random seed used to place the features
+
+Returns a dict with:
+dem = Original DEM (float32)
+dem_clipped = DEM with all features set to bad_data
+masks = Dict with the mask of each feature
+fan_catchment_match = Dict with the catchment matching each fan
+crater_center = [x, y] of the crater center in pixels
+true_volumes = Dict with the sum of the heights added/carved for each feature, as a volume in km^3
+analytic_volumes = Dict with the continuous volume of each feature's paraboloid in km^3
+pixel_size = pixel_size
+'''
+def make_crater(size=1000, n_pairs=4, pixel_size=20.0, bad_data=32767, seed=0):
+    rng = np.random.default_rng(seed)
+    center = [size/2 + 0.3, size/2 - 0.2]
+    radius = 0.4*size
+    depth = 0.2*radius*pixel_size
+
+    #parabolic bowl, flat outside the rim
+    yy, xx = np.ogrid[:size, :size]
+    r2 = ((xx - center[0])**2 + (yy - center[1])**2) / radius**2
+    dem = np.where(r2 < 1, -depth*(1 - r2), 0).astype(np.float32)
+    del r2
+
+    masks = {}
+    fan_catchment_match = {}
+    true_volumes = {}
+    analytic_volumes = {}
+    to_km3 = pixel_size*pixel_size/1e9
+    angles = 2*np.pi*(np.arange(n_pairs) + rng.uniform(0.2, 0.8, n_pairs))/n_pairs
+    for i, angle in enumerate(angles):
+        fan = 'Fan_' + str(i + 1)
+        catchment = 'Catchment_' + str(i + 1)
+
+        #fan lobe on the floor, pointing towards the center
+        a, b = 0.12*radius, 0.07*radius
+        h = 0.05*depth
+        x0 = center[0] + 0.62*radius*np.cos(angle)
+        y0 = center[1] + 0.62*radius*np.sin(angle)
+        masks[fan], volume = add_paraboloid(dem, x0, y0, a, b, h, angle)
+        true_volumes[fan] = volume*to_km3
+        analytic_volumes[fan] = np.pi*a*b*h/2*to_km3
+
+        #catchment carved into the wall above the fan
+        a, b = 0.08*radius, 0.05*radius
+        h = -0.08*depth
+        x0 = center[0] + 0.86*radius*np.cos(angle)
+        y0 = center[1] + 0.86*radius*np.sin(angle)
+        masks[catchment], volume = add_paraboloid(dem, x0, y0, a, b, h, angle)
+        true_volumes[catchment] = -volume*to_km3
+        analytic_volumes[catchment] = -np.pi*a*b*h/2*to_km3
+
+        fan_catchment_match[fan] = catchment
+
+    dem_clipped = dem.copy()
+    for key in masks:
+        dem_clipped[masks[key]] = bad_data
+
+    return {'dem': dem, 'dem_clipped': dem_clipped, 'masks': masks, 'fan_catchment_match': fan_catchment_match,
+            'crater_center': center, 'true_volumes': true_volumes, 'analytic_volumes': analytic_volumes,
+            'pixel_size': pixel_size}
+
+'''
+Returns the per-feature DEMs for a synthetic crater: a copy of the DEM with one feature set to bad_data, for each
+feature. These are the equivalent of the per-feature files exported from ArcMap. Each is made only when the
+generator reaches it, to avoid holding them all in memory.
+'''
+def feature_dems(crater, bad_data=32767):
+    for key in crater['masks']:
+        feature_dem = crater['dem'].copy()
+        feature_dem[crater['masks'][key]] = bad_data
+        yield key, feature_dem